@@ -11,15 +11,27 @@ from chalice.cdk import Chalice
 RUNTIME_SOURCE_DIR = os.path.join(
     os.path.dirname(os.path.dirname(__file__)), os.pardir, 'runtime')
 
+# Lambda functions fed by SQS, by their logical id in the Chalice SAM template
+SQS_CONSUMERS = ('EnqueueFollows', 'ProcessNow')
+# seconds SQS waits to fill a batch before invoking a consumer
+BATCHING_WINDOW_SECONDS = 5
+# deliveries before a message that keeps failing goes to the dead-letter queue
+MAX_RECEIVE_COUNT = 5
+
 
 class ChaliceApp(cdk.Stack):
 
     def __init__(self, scope, id, **kwargs):
         super().__init__(scope, id, **kwargs)
         self.dynamodb_table = self._create_ddb_table()
-        self.now_queue = self._create_sqs_queue('do-now')
+        self.dead_letter_queue = self._create_sqs_queue('dead-letter')
+        self.now_queue = self._create_sqs_queue(
+            'do-now', dead_letter_queue=self.dead_letter_queue)
         self.later_queue = self._create_sqs_queue('do-later')
-        self.process_queue = self._create_sqs_queue('process')
+        self.process_queue = self._create_sqs_queue(
+            'process', dead_letter_queue=self.dead_letter_queue)
+        # delayed messages that start the drain when quota frees up
+        self.wake_queue = self._create_sqs_queue('wake-up')
         self.chalice = Chalice(
             self, 'ChaliceApp', source_dir=RUNTIME_SOURCE_DIR,
             stage_config={
@@ -28,33 +40,58 @@ class ChaliceApp(cdk.Stack):
                     'APP_DO_NOW_QUEUE_NAME': self.now_queue.queue_name,
                     'APP_DO_LATER_QUEUE_NAME': self.later_queue.queue_name,
                     'APP_PROCESS_QUEUE_NAME': self.process_queue.queue_name,
+                    'APP_WAKE_QUEUE_NAME': self.wake_queue.queue_name,
                 }
             }
         )
         self.dynamodb_table.grant_read_write_data(
             self.chalice.get_role('DefaultRole')
         )
-        for queue in (self.now_queue, self.later_queue, self.process_queue):
+        for queue in (self.now_queue, self.later_queue, self.process_queue,
+                      self.wake_queue):
             queue.grant_send_messages(
                 self.chalice.get_role('DefaultRole')
             )
             queue.grant_consume_messages(
                 self.chalice.get_role('DefaultRole')
             )
+        for function_name in SQS_CONSUMERS:
+            self._report_batch_item_failures(function_name)
 
     def _create_ddb_table(self, name: str='AppTable'):
         dynamodb_table = dynamodb.Table(
             self, name,
             partition_key=dynamodb.Attribute(
                 name='user_id', type=dynamodb.AttributeType.STRING),
+            time_to_live_attribute='expires_at',
             removal_policy=cdk.RemovalPolicy.DESTROY)
+        # jobs waiting longer than SQS can delay a message, by due time
+        dynamodb_table.add_global_secondary_index(
+            index_name='due-index',
+            partition_key=dynamodb.Attribute(
+                name='job_shard', type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(
+                name='due_at', type=dynamodb.AttributeType.NUMBER))
         cdk.CfnOutput(self, f'{name}Name',
                       value=dynamodb_table.table_name)
         return dynamodb_table
 
-    def _create_sqs_queue(self, name: str='AppQueue'):
+    def _create_sqs_queue(self, name: str='AppQueue', dead_letter_queue=None):
+        # consumers get six times their 60 second timeout, as Lambda recommends for batches
         queue = sqs.Queue(
-            self, name, queue_name=name, visibility_timeout=cdk.Duration.seconds(60)
+            self, name, queue_name=name, visibility_timeout=cdk.Duration.seconds(360),
+            dead_letter_queue=dead_letter_queue and sqs.DeadLetterQueue(
+                max_receive_count=MAX_RECEIVE_COUNT, queue=dead_letter_queue)
         )
         cdk.CfnOutput(self, f'{name}Name', value=queue.queue_name)
         return queue
+
+    def _report_batch_item_failures(self, function_name: str):
+        # Chalice doesn't expose these yet, so set them on its SQS event source
+        properties = f'Events.{function_name}SqsEventSource.Properties'
+        function = self.chalice.get_resource(function_name)
+        function.add_property_override(
+            f'{properties}.FunctionResponseTypes', ['ReportBatchItemFailures'])
+        function.add_property_override(
+            f'{properties}.MaximumBatchingWindowInSeconds',
+            BATCHING_WINDOW_SECONDS)
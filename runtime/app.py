@@ -1,7 +1,7 @@
 import json
 import os
 import time
-from typing import Tuple, List, Optional
+from typing import Tuple, List, Optional, Set, Iterator, NamedTuple, AbstractSet, Dict
 
 import tweepy
 from chalice import Rate, Chalice
@@ -9,15 +9,57 @@ from chalice.app import SQSEvent, CloudWatchEvent
 from tweepy import Cursor as cursor
 from tweepy.models import User
 
-from chalicelib.db import DynamoDBTwitterList as db
-from chalicelib.process_follow import ProcessFollow
-from chalicelib.utils import queues, locked_out
+from chalicelib.db import (
+    DynamoDBTwitterList as db,
+    QuotaSnapshot,
+    quota_window,
+    quota_window_end,
+)
+from chalicelib.executor import run_in_lanes
+from chalicelib.scheduler import Job, deficit_round_robin, split_by_share
+from chalicelib.process_follow import (
+    ProcessFollow,
+    ApiCache,
+    lockout_for_error,
+    rate_limit_from_response,
+    delay_until,
+    follow_job,
+    job_follower_ids,
+    job_reserved,
+    reserved_job,
+    USER_SCOPE,
+    APP_SCOPE,
+    RETRY_SECONDS,
+    MAX_DELAY_SECONDS,
+    FOLLOWERS_PER_JOB,
+    CREDENTIAL_KEYS,
+)
+from chalicelib.utils import (
+    queues,
+    send_messages_in_batches,
+    unsent_messages,
+    delete_messages_in_batches,
+    receive_wait_seconds,
+    running_out_of_time,
+    seconds_left,
+    follows_in_flight,
+    queue,
+    queue_backlog,
+    chunked,
+    SQS_BATCH_SIZE,
+)
 
 app = Chalice(app_name="twitter-list-follower")
 app.debug = True
 
-TWITTER_LIMIT = 1000
-USER_LIMIT = 400
+# the most ids Twitter returns per friends/ids request, and the most members per lists/members request
+FRIENDS_IDS_PAGE_SIZE = 5000
+LIST_MEMBERS_PAGE_SIZE = 5000
+
+# how long a received batch stays hidden from other consumers; longer than an invocation may run
+DRAIN_VISIBILITY_TIMEOUT = 120
+# how many 'do later' jobs the drain schedules between at once
+SCHEDULING_WINDOW = 100
 
 _DB = None
 
@@ -37,119 +79,656 @@ def reconstruct_twitter_api(message_body: dict) -> tweepy.API:
     return ProcessFollow().reconstruct_twitter_api(message_body)
 
 
-@app.on_sqs_message(queue="process", batch_size=1, name="enqueue_follows")
+# authenticated clients, kept for as long as the container stays warm
+api_cache = ApiCache()
+
+
+@app.on_sqs_message(queue="process", batch_size=SQS_BATCH_SIZE, name="enqueue_follows")
 def enqueue_follows(event: SQSEvent):
-    for record in event:
+    def fan_out_record(record):
         message_body = dict(json.loads(record.body))
-        twitter_api = reconstruct_twitter_api(message_body)
-        to_follow, requests_to_process_now = get_people_to_follow(
-            twitter_api, message_body["list_id"]
+        job_id = message_body.get("job_id") or message_id(record)
+        fan_out(message_body, job_id, event.context)
+
+    def release(records) -> bool:
+        # the job id goes with each message, so whoever picks it up carries on the same checkpoint
+        bodies = [
+            json.dumps({"job_id": message_id(record), **json.loads(record.body)})
+            for record in records
+        ]
+        return send_messages_in_batches(queues()[2], bodies) == len(bodies)
+
+    return process_batch(event, fan_out_record, release)
+
+
+def message_id(record) -> str:
+    return record.to_dict()["messageId"]
+
+
+def process_batch(event: SQSEvent, process_record, release=None) -> dict:
+    """
+    Runs 'process_record' on each record of an SQS batch and returns a partial batch response, so SQS only redelivers
+    the records that failed. Records that are still waiting when the invocation is about to time out aren't started.
+    They're handed to 'release', which sends them on as new messages so another invocation picks them up straight
+    away and returns whether it managed to, instead of leaving them hidden until their visibility timeout runs out.
+    Without 'release', or if it fails, they're reported as failed. A record that keeps failing ends up on the queue's
+    dead-letter queue.
+    """
+    failed, waiting = [], []
+    for position, record in enumerate(event):
+        if position and running_out_of_time(event.context):
+            waiting.append(record)
+            continue
+        try:
+            process_record(record)
+        except Exception:
+            app.log.exception("Failed to process message %s", message_id(record))
+            failed.append(message_id(record))
+    if waiting and not (release is not None and release(waiting)):
+        failed.extend(message_id(record) for record in waiting)
+    return {"batchItemFailures": [{"itemIdentifier": failure} for failure in failed]}
+
+
+def fan_out(message_body: dict, job_id: str, context=None) -> int:
+    """
+    Enqueues follow jobs for everyone in the requested list, a page at a time. After each page the list cursor and
+    the number enqueued so far are checkpointed against 'job_id', so a retry of the same message carries on where the
+    last attempt stopped. If the invocation is about to time out, a continuation message is put on the 'process'
+    queue and this one stops. Returns how many follow jobs this invocation enqueued.
+    Members already enqueued for the user from an earlier request for the same list are skipped, so re-requesting a
+    list only picks up its new members, unless the message asks for a 'full_sync'. If any follows have to wait, a
+    wake-up is armed for when they can run.
+    """
+    do_now_queue, do_later_queue, process_queue = queues()
+    checkpoint = get_app_db().get_checkpoint(job_id)
+    if checkpoint.get("done"):
+        return 0
+    start_cursor = int(checkpoint.get("cursor", message_body.get("cursor", -1)))
+    enqueued_before = int(checkpoint.get("enqueued", 0))
+    credentials = credentials_for(message_body)
+    if credentials is None:
+        app.log.error("No credentials for user %s", message_body.get("user_id"))
+        return 0
+    cached_api = api_cache.get(
+        credentials, lambda: reconstruct_twitter_api(credentials)
+    )
+    twitter_api = cached_api.api
+    list_id = message_body["list_id"]
+    user_id = message_body.get("user_id") or cached_api.user_id()
+    if all(key in message_body for key in CREDENTIAL_KEYS):
+        get_app_db().save_credentials(
+            user_id, *(message_body[key] for key in CREDENTIAL_KEYS)
         )
-        for i, follower in enumerate(to_follow):
-            message = message_body.copy()
-            message["follower_id"] = follower.id_str
-            message = json.dumps(message)
-            do_now_queue, do_later_queue = queues()[:2]
-            if i >= requests_to_process_now:
-                do_later_queue.send_message(MessageBody=message)
-            else:
-                do_now_queue.send_message(MessageBody=message)
+    job = {"user_id": user_id, "list_id": list_id, "job_id": job_id}
+    syncing = not message_body.get("full_sync")
+    already_synced = (
+        get_app_db().get_synced_members(user_id, list_id) if syncing else frozenset()
+    )
+    enqueued, deferred = 0, False
+    for follow_now, follow_later, next_cursor in get_people_to_follow(
+        twitter_api, list_id, user_id, start_cursor, already_synced
+    ):
+        enqueued += sum(
+            enqueue_follow_jobs(
+                job, follow_now, follow_later, do_now_queue, do_later_queue
+            )
+        )
+        deferred = deferred or bool(follow_later)
+        if syncing and (follow_now or follow_later):
+            get_app_db().add_synced_members(user_id, list_id, follow_now + follow_later)
+        done = next_cursor == 0
+        get_app_db().save_checkpoint(
+            job_id, next_cursor, enqueued_before + enqueued, done
+        )
+        if not done and running_out_of_time(context):
+            continuation = {
+                key: value
+                for key, value in message_body.items()
+                if key not in CREDENTIAL_KEYS
+            }
+            process_queue.send_message(
+                MessageBody=json.dumps({**continuation, **job, "cursor": next_cursor})
+            )
+            break
+    else:
+        get_app_db().save_checkpoint(job_id, 0, enqueued_before + enqueued, True)
+    if deferred:
+        arm_wake_up()
+    return enqueued
+
+
+def credentials_for(message_body: dict) -> Optional[dict]:
+    """
+    The access token to act with for a message. Requests carry their own; jobs only say whose token to look up.
+    """
+    if all(key in message_body for key in CREDENTIAL_KEYS):
+        return {key: message_body[key] for key in CREDENTIAL_KEYS}
+    return get_app_db().get_credentials(message_body["user_id"])
+
+
+def enqueue_follow_jobs(
+    job: dict,
+    follow_now: List[str],
+    follow_later: List[str],
+    do_now_queue,
+    do_later_queue,
+) -> Tuple[int, int]:
+    """
+    Packs the ids to follow into follow jobs of up to FOLLOWERS_PER_JOB ids each and sends the jobs to SQS in batches,
+    'follow_now' to the 'do now' queue and 'follow_later' to the 'do later' queue. The follows for now have been
+    reserved, and their jobs say so. Returns how many follows were enqueued on each queue.
+    """
+    try:
+        now = send_follow_jobs(do_now_queue, reserved_job(job), follow_now)
+    except FollowJobsNotSent as e:
+        # the retry reserves them again
+        get_app_db().return_quota(job["user_id"], e.follows)
+        raise
+    return now, send_follow_jobs(do_later_queue, job, follow_later)
+
+
+class FollowJobsNotSent(Exception):
+    """
+    SQS wouldn't take some of a page's follow jobs
+    """
+
+    def __init__(self, user_id: str, jobs: int, follows: int):
+        super().__init__(
+            f"{jobs} follow jobs for user {user_id}, with {follows} follows, weren't sent"
+        )
+        self.follows = follows
+
+
+def send_follow_jobs(queue, job: dict, follower_ids: List[str]) -> int:
+    """
+    Sends the follow jobs for 'follower_ids'. Raises FollowJobsNotSent if any of them couldn't be sent, so the fan-out
+    fails before the page is checkpointed or synced and is retried from the page.
+    """
+    batches = list(chunked(follower_ids, FOLLOWERS_PER_JOB))
+    unsent = unsent_messages(
+        queue, (json.dumps(follow_job(job, batch)) for batch in batches)
+    )
+    if unsent:
+        raise FollowJobsNotSent(
+            job["user_id"], len(unsent), sum(len(batches[i]) for i in unsent)
+        )
+    return len(follower_ids)
 
 
 @app.schedule(Rate(1, Rate.HOURS))
 def process_later(event: CloudWatchEvent):
     """
-    This function checks if there's capacity to do any following today. If there is, it polls the 'do_later_queue' to see if there's anything to process.
-    If there is it processes the follows.
+    This function checks if there's capacity to do any following today. If there is, it releases any parked jobs that
+    are due and drains the 'do_later_queue'. Wake-ups do the same as soon as there's capacity again, so this hourly
+    run is only a safety net in case one goes missing.
     """
-    if locked_out():
-        pass
-    else:
-        db = get_app_db()
-        db.reset_counts()
-        do_later_queue = queues()[1]
-        while not locked_out():
-            messages = do_later_queue.receive_messages(
-                VisibilityTimeout=1, MaxNumberOfMessages=10
-            )
-            if not messages:
-                break
-            else:
-                for message in messages:
-                    process_follow_from_record(message)
-                # update the db here?
+    catch_up(event.context)
     return 0
 
 
-@app.on_sqs_message(queue="do-now", batch_size=1)
-def process_now(event: SQSEvent):
+@app.on_sqs_message(queue="wake-up", batch_size=1)
+def wake_up(event: SQSEvent):
     """
-    This function processes all items in the queue right now
+    Handles a wake-up armed by 'arm_wake_up'. SQS can only delay a message for 15 minutes, so a wake-up that is due
+    later than that is passed on until it is due.
     """
-    do_later_queue = queues()[1]
     for record in event:
-        if not locked_out():
+        wake_at = json.loads(record.body)["wake_at"]
+        if time.time() < wake_at:
+            wake_up_queue().send_message(
+                MessageBody=record.body, DelaySeconds=delay_until(wake_at)
+            )
+        else:
+            catch_up(event.context)
+
+
+def wake_up_queue():
+    return queue("wake")
+
+
+def catch_up(context=None):
+    """
+    Releases the parked jobs that are due and drains the 'do later' queue, unless the app is locked out, then arms a
+    wake-up for whenever there's more to do. If the invocation ran out of time with jobs still on the queue, that's
+    straight away, so a follow-up invocation carries on where this one stopped.
+    """
+    if not get_app_db().locked_out():
+        release_due_jobs(context)
+        drain_later_queue(context)
+    arm_wake_up()
+
+
+def next_wake_at() -> Optional[float]:
+    """
+    The next moment there's following to do and the quota to do it: when the app's lockout ends, when today's follows
+    are used up and tomorrow starts, or else when the first waiting job can run, whether it's on the 'do later'
+    queue now, delayed on it, or parked. None if nothing is waiting.
+    """
+    snapshot = get_app_db().quota_snapshot()
+    if snapshot.locked_out():
+        return snapshot.app_blocked_until
+    if snapshot.app_left <= 0:
+        return quota_window_end(quota_window())
+    waiting, delayed = queue_backlog(queues()[1])
+    candidates = [get_app_db().next_due_at()]
+    if waiting:
+        candidates.append(time.time())
+    if delayed:
+        candidates.append(time.time() + MAX_DELAY_SECONDS)
+    return min((c for c in candidates if c is not None), default=None)
+
+
+def arm_wake_up() -> Optional[float]:
+    """
+    Sends a wake-up message for 'next_wake_at', unless one that's due sooner is already on its way. Returns when the
+    armed wake-up is due, or None if none was sent.
+    """
+    wake_at = next_wake_at()
+    if wake_at is None or not get_app_db().arm_wake_up(wake_at):
+        return None
+    wake_up_queue().send_message(
+        MessageBody=json.dumps({"wake_at": wake_at}),
+        DelaySeconds=delay_until(wake_at),
+    )
+    return wake_at
+
+
+def drain_later_queue(context=None) -> int:
+    """
+    Processes the 'do later' queue until it's empty, the app is locked out, today's follows are used up, or the
+    invocation is about to time out. Each pass takes a window of jobs off the queue and shares what's left of today's
+    follows between their users by deficit round robin, so a user with a long list can't hold up everyone behind
+    them; see 'schedule_window'. Each job then reserves its share before following, so drains running at the same
+    time can't hand out the same follows. Follows for different users are made concurrently, up to 'follows_in_flight'
+    requests at once. A job that hasn't been started when the invocation is about to time out is put back as it came.
+    Every message in the window is deleted once its follows have been made or put back, so it isn't followed again.
+    Returns how many jobs were processed.
+    """
+    do_later_queue = queues()[1]
+    handled = 0
+    while not running_out_of_time(context):
+        snapshot = get_app_db().quota_snapshot()
+        if snapshot.locked_out() or snapshot.app_left <= 0:
+            break
+        messages = receive_window(do_later_queue, context)
+        if not messages:
+            break
+        jobs = [Job.from_body(message.body) for message in messages]
+        snapshot = get_app_db().quota_snapshot(job.user_id for job in jobs)
+        scheduled = schedule_window(jobs, snapshot, do_later_queue)
+        released = []
+
+        def follow(job: Job):
+            if running_out_of_time(context):
+                # not started, so it goes back as it came
+                released.append(job)
+                return
+            process_follow_from_record(job, context)
+
+        done = run_in_lanes(
+            scheduled,
+            lane=lambda job: job.user_id,
+            work=follow,
+            max_workers=follows_in_flight(),
+        )
+        unfinished = [job for job in scheduled if job not in done or job in released]
+        send_messages_in_batches(do_later_queue, [job.body for job in unfinished])
+        delete_messages_in_batches(
+            do_later_queue, [message.receipt_handle for message in messages]
+        )
+        handled += len(scheduled) - len(unfinished)
+    return handled
+
+
+def receive_window(do_later_queue, context=None) -> list:
+    """
+    Receives up to SCHEDULING_WINDOW messages, ten at a time. Only the first receive long-polls, and for no longer
+    than the invocation has left.
+    """
+    messages = []
+    wait_seconds = receive_wait_seconds()
+    left = seconds_left(context)
+    if left is not None:
+        wait_seconds = max(min(wait_seconds, int(left)), 0)
+    while len(messages) < SCHEDULING_WINDOW:
+        received = do_later_queue.receive_messages(
+            VisibilityTimeout=DRAIN_VISIBILITY_TIMEOUT,
+            MaxNumberOfMessages=SQS_BATCH_SIZE,
+            WaitTimeSeconds=wait_seconds,
+        )
+        if not received:
+            break
+        messages.extend(received)
+        wait_seconds = 0
+    return messages
+
+
+def schedule_window(
+    jobs: List[Job], snapshot: QuotaSnapshot, do_later_queue
+) -> List[Job]:
+    """
+    Decides which follows in a window of jobs to make now, going by a quota 'snapshot' that covers their users. What's
+    left of today's follows is shared between the users by deficit round robin, each asking for no more than what's
+    left of their own follows today, and those who are locked out asking for none; a user with no follows left is
+    locked out until tomorrow. Returns the jobs to run now. The rest are put back: on the 'do later' queue if they
+    only missed out on their turn, or until the user's lockout ends, or until tomorrow if the user has run out of
+    follows for today. Jobs whose follows were reserved today, when they were enqueued, run now without a share.
+    """
+    # jobs whose follows were reserved when they were enqueued don't need a share
+    reserved = [job for job in jobs if job_reserved(json.loads(job.body))]
+    jobs = [job for job in jobs if job not in reserved]
+    demands: Dict[str, int] = {}
+    for job in jobs:
+        demands[job.user_id] = demands.get(job.user_id, 0) + len(job.follower_ids)
+    wait_until: Dict[str, float] = {}
+    for user_id, demand in demands.items():
+        blocked_until = snapshot.blocked_until(user_id)
+        left_today = snapshot.user_left(user_id)
+        if time.time() < blocked_until:
+            wait_until[user_id] = blocked_until
+            demands[user_id] = 0
+        elif demand > left_today:
+            wait_until[user_id] = quota_window_end(quota_window())
+            demands[user_id] = max(left_today, 0)
+            if left_today <= 0:
+                get_app_db().lock_out(wait_until[user_id], scope=user_id)
+    shares = deficit_round_robin(demands, snapshot.app_left)
+    scheduled, leftover = split_by_share(jobs, shares)
+    missed_turn = []
+    for job in leftover:
+        if job.user_id in wait_until and shares[job.user_id] == demands[job.user_id]:
+            retry_later(job.body, wait_until[job.user_id], do_later_queue)
+        else:
+            missed_turn.append(job.body)
+    send_messages_in_batches(do_later_queue, missed_turn)
+    return reserved + scheduled
+
+
+@app.on_sqs_message(queue="do-now", batch_size=SQS_BATCH_SIZE)
+def process_now(event: SQSEvent):
+    """
+    This function processes all items in the queue right now, up to ten at a time
+    """
+    do_now_queue, do_later_queue = queues()[:2]
+
+    def process_record(record):
+        if not get_app_db().locked_out():
             # not blocked
-            process_follow_from_record(record)
+            process_follow_from_record(record, event.context, do_now_queue)
         else:
             do_later_queue.send_message(MessageBody=record.body)
 
+    def release(records) -> bool:
+        bodies = [record.body for record in records]
+        return send_messages_in_batches(do_now_queue, bodies) == len(bodies)
+
+    response = process_batch(event, process_record, release)
+    arm_wake_up()
+    return response
+
 
 def get_people_to_follow(
-    twitter_api: tweepy.API, list_to_follow: Optional[str] = None
-) -> Tuple[List[User], int]:
+    twitter_api: tweepy.API,
+    list_to_follow: Optional[str] = None,
+    user_id: Optional[str] = None,
+    start_cursor: int = -1,
+    already_synced: AbstractSet[str] = frozenset(),
+) -> Iterator[Tuple[List[str], List[str], int]]:
     """
-    This will access the Twitter API. It takes the Twitter list we'll be following and draws down the users in that list.
-    It then filters out those that the user already follows, and then enqueues each request. If we've made 1,000
-    requests today, or 400 for this user, the request will have to be added to the 'do later' queue.
+    This will access the Twitter API. It takes the Twitter list we'll be following and draws down the users in that list,
+    a page at a time from 'start_cursor'. It filters out those that the user already follows or that are in
+    'already_synced', and yields the ids on each page split into those we can follow now and those that have to wait,
+    along with the cursor of the next page (0 after the last one). If we've made 1,000 requests today, or 400 for this user, the request will have to be added
+    to the 'do later' queue.
     """
     if list_to_follow is None:
         raise ValueError()
         # hard-coding the list for the data collective
-    to_follow: List[User] = [
-        member
-        for member in cursor(twitter_api.list_members, list_id=list_to_follow).items()
-    ]
-    count_requests_to_make = len(to_follow)
-
-    all_requests_today = get_app_db().get_item("twitter-api").get("count", 0)
-    user_requests_today = get_app_db().get_item(twitter_api.me().id_str).get("count", 0)
-    if user_requests_today >= USER_LIMIT or all_requests_today >= TWITTER_LIMIT:
+    if user_id is None:
+        user_id = twitter_api.me().id_str
+    already_following = get_friend_ids(twitter_api)
+    quota_left = True
+    for page, next_cursor in iter_list_members(
+        twitter_api, list_to_follow, start_cursor
+    ):
+        to_follow = [
+            member.id_str
+            for member in page
+            if member.id_str not in already_synced
+            and is_new_follow(member, already_following)
+        ]
         requests_to_process_now = 0
-    else:
-        requests_left_today = (
-            (TWITTER_LIMIT - all_requests_today),
-            (USER_LIMIT - user_requests_today),
-            count_requests_to_make,
+        if to_follow and quota_left:
+            requests_to_process_now = get_app_db().reserve_quota(
+                user_id, len(to_follow)
+            )
+            quota_left = requests_to_process_now == len(to_follow)
+        yield (
+            to_follow[:requests_to_process_now],
+            to_follow[requests_to_process_now:],
+            next_cursor,
         )
-        requests_to_process_now = min(requests_left_today)
-        get_app_db().update_item("twitter-api", "count", requests_to_process_now)
-        get_app_db().update_item(
-            twitter_api.me().id_str, "count", requests_to_process_now
+
+
+class ListMember(NamedTuple):
+    """
+    The little we need to know about a list member, instead of tweepy's full User model
+    """
+
+    id_str: str
+    following: bool = False
+    follow_request_sent: bool = False
+    protected: bool = False
+
+    @classmethod
+    def from_user(cls, user: User) -> "ListMember":
+        return cls(
+            user.id_str,
+            bool(getattr(user, "following", False)),
+            bool(getattr(user, "follow_request_sent", False)),
+            bool(getattr(user, "protected", False)),
         )
-    return to_follow, requests_to_process_now
 
 
-def process_follow_from_record(message):
+def list_cache_seconds() -> int:
+    """
+    How long a snapshot of a list's members is used before the list is fetched from Twitter again
+    """
+    return int(os.environ.get("APP_LIST_CACHE_SECONDS", 3600))
+
+
+def iter_list_members(
+    twitter_api: tweepy.API, list_id: str, start_cursor: int = -1
+) -> Iterator[Tuple[List[ListMember], int]]:
+    """
+    Yields the members of a list a page at a time, without their latest tweets, keeping only what 'ListMember' holds.
+    Each page comes with the cursor of the page after it, which is 0 once there are no more.
+    Lists are shared between requesters, so a fresh snapshot of the member ids is used instead of Twitter when there
+    is one. Otherwise, the pages fetched from Twitter are yielded as they arrive and the snapshot is rewritten once
+    the whole list has been read.
     """
-    This function takes a person to follow and the requester's credentials and then touches the Twitter API to carry out this command. If the Twitter API
-    responds with a 429, we've asked too many times, and will need to back off.
+    from_start = start_cursor == -1
+    if from_start:
+        snapshot = get_app_db().get_list_snapshot(list_id, list_cache_seconds())
+        if snapshot is not None:
+            yield [ListMember(member_id) for member_id in snapshot], 0
+            return
+    pages = cursor(
+        twitter_api.list_members,
+        list_id=list_id,
+        count=LIST_MEMBERS_PAGE_SIZE,
+        skip_status=True,
+        cursor=start_cursor,
+    ).pages()
+    member_ids: List[str] = []
+    for page in pages:
+        members = [ListMember.from_user(user) for user in page]
+        if from_start:
+            member_ids.extend(member.id_str for member in members)
+        yield members, int(getattr(pages, "next_cursor", 0))
+    if from_start:
+        get_app_db().save_list_snapshot(list_id, member_ids)
+
+
+def get_friend_ids(twitter_api: tweepy.API) -> Set[str]:
+    """
+    The ids of everyone the requester already follows, fetched 5,000 at a time
+    """
+    return {
+        str(friend_id)
+        for page in cursor(twitter_api.friends_ids, count=FRIENDS_IDS_PAGE_SIZE).pages()
+        for friend_id in page
+    }
+
+
+def is_new_follow(member: ListMember, already_following: Set[str]) -> bool:
+    """
+    Whether following this list member would actually do anything, so we don't spend a follow on someone the user
+    already follows or has already asked to follow
+    """
+    if member.following or member.id_str in already_following:
+        return False
+    # following a protected account sends a request, which may already be pending
+    return not (member.protected and member.follow_request_sent)
+
+
+def process_follow_from_record(message, context=None, requeue=None):
+    """
+    This function takes a follow job, which names the people to follow and the requester, and then touches the Twitter
+    API to follow them one at a time with the requester's credentials. If the Twitter API responds with a 429, we've
+    asked too many times, and will need to back off. Depending on the error, that means locking out the requester, the
+    whole app, or nobody; see 'lockout_for_error'. When the requester is locked out, whoever is left in the job waits
+    for the lockout on the 'do later' queue. If the invocation is about to time out, they go back on 'requeue' (the
+    'do later' queue unless told otherwise). Unless the job's follows were reserved today, they're reserved first;
+    whoever there's no quota left for waits until tomorrow, and the app or the requester, whichever ran out, is locked
+    out until then. Each follow is claimed in the ledger before it's made, and given back if it's to be retried, so a job
+    delivered twice follows nobody twice; reserved follows that won't be made are given back too.
     When we upgrade to V2 of the API, we'll have to change some of the backing off
     """
     do_later_queue = queues()[1]
-    if locked_out():
-        do_later_queue.send_message(MessageBody=message.body, DelaySeconds=900)
-    else:
-        message_body = json.loads(message.body)
+    requeue = requeue or do_later_queue
+    message_body = json.loads(message.body)
+    user_id = message_body["user_id"]
+    blocked_until = max(
+        get_app_db().blocked_until(), get_app_db().blocked_until(user_id)
+    )
+    if time.time() < blocked_until:
+        retry_later(message.body, blocked_until, do_later_queue)
+        return
+    credentials = credentials_for(message_body)
+    if credentials is None:
+        app.log.error("No credentials for user %s", user_id)
+        return
+
+    def build_api() -> tweepy.API:
         auth = tweepy_auth()
         auth.set_access_token(
-            message_body["access_token"], message_body["access_token_secret"]
+            credentials["access_token"], credentials["access_token_secret"]
         )
-        api = tweepy.API(auth)
-        try:
-            api.create_friendship(id=message_body["follower_id"])
-            get_app_db().increase_count_by_one(message_body["user_id"])
-            get_app_db().increase_count_by_one("app")
-        except tweepy.TweepError as e:
-            do_later_queue.send_message(MessageBody=message.body, DelaySeconds=900)
-            os.environ["BLOCKED_UNTIL"] = str(int(time.time()) + 86400)
+        return tweepy.API(auth)
+
+    api = api_cache.get(credentials, build_api).api
+    follower_ids = job_follower_ids(message_body)
+    body = message.body
+    if not job_reserved(message_body):
+        granted = get_app_db().reserve_quota(user_id, len(follower_ids))
+        if granted < len(follower_ids):
+            retry_at = quota_window_end(quota_window())
+            snapshot = get_app_db().quota_snapshot([user_id])
+            if snapshot.app_left <= 0:
+                get_app_db().lock_out(retry_at, scope=APP_SCOPE)
+            elif snapshot.user_left(user_id) <= 0:
+                get_app_db().lock_out(retry_at, scope=user_id)
+            else:
+                # neither ran out, the reservation lost too many races
+                retry_at = time.time() + RETRY_SECONDS
+            rest = reserved_job(message_body, reserved=False)
+            if granted:
+                rest = follow_job(rest, follower_ids[granted:])
+                message_body = follow_job(message_body, follower_ids[:granted])
+            retry_later(json.dumps(rest), retry_at, do_later_queue)
+            follower_ids = follower_ids[:granted]
+        message_body = reserved_job(message_body)
+        body = json.dumps(message_body)
+
+    def job_for(ids: List[str]) -> str:
+        # a job nobody in has been followed yet goes back as it came
+        if ids == follower_ids:
+            return body
+        return json.dumps(follow_job(message_body, ids))
+
+    not_made = 0
+    try:
+        for position, follower_id in enumerate(follower_ids):
+            if position and running_out_of_time(context):
+                requeue.send_message(MessageBody=job_for(follower_ids[position:]))
+                return
+            if not get_app_db().claim_follow(user_id, follower_id):
+                # followed already, by an earlier delivery of this job or by another one
+                not_made += 1
+                continue
+            try:
+                api.create_friendship(id=follower_id)
+                get_app_db().increase_counts(user_id, "app")
+                rate_limit = rate_limit_from_response(
+                    getattr(api, "last_response", None)
+                )
+                if rate_limit is not None and rate_limit.remaining <= 0:
+                    # that was the last follow this window allows, so don't wait for a 429
+                    get_app_db().lock_out(rate_limit.reset, scope=user_id)
+                    rest = follower_ids[position + 1 :]
+                    if rest:
+                        retry_later(job_for(rest), rate_limit.reset, do_later_queue)
+                    return
+            except tweepy.TweepError as e:
+                lockout = lockout_for_error(e)
+                if lockout.retry:
+                    get_app_db().release_follow(user_id, follower_id)
+                else:
+                    not_made += 1
+                retry_at = time.time() + RETRY_SECONDS
+                if lockout.scope is not None:
+                    retry_at = time.time() + lockout.seconds
+                    get_app_db().lock_out(
+                        retry_at,
+                        scope=user_id if lockout.scope == USER_SCOPE else lockout.scope,
+                    )
+                    rest = follower_ids[position if lockout.retry else position + 1 :]
+                    if rest:
+                        retry_later(job_for(rest), retry_at, do_later_queue)
+                    return
+                if lockout.retry:
+                    retry_later(job_for([follower_id]), retry_at, do_later_queue)
+    finally:
+        get_app_db().return_quota(user_id, not_made)
+
+
+def retry_later(message_body: str, retry_at: float, do_later_queue):
+    """
+    Puts a job back on the 'do later' queue so it reappears at 'retry_at'. SQS can only hide a message for 15 minutes,
+    so jobs that have to wait longer are parked in the database until 'process_later' releases them.
+    """
+    if retry_at - time.time() > MAX_DELAY_SECONDS:
+        get_app_db().defer_job(message_body, retry_at)
+    else:
+        do_later_queue.send_message(
+            MessageBody=message_body, DelaySeconds=delay_until(retry_at)
+        )
+
+
+def release_due_jobs(context=None) -> int:
+    """
+    Moves every parked job that is now due back onto the 'do later' queue, in batches, until the invocation is about
+    to time out. Returns how many were released.
+    """
+    do_later_queue = queues()[1]
+    released = 0
+    while not running_out_of_time(context):
+        jobs = get_app_db().due_jobs()
+        if not jobs:
+            return released
+        released += send_messages_in_batches(
+            do_later_queue, (job["body"] for job in jobs)
+        )
+        get_app_db().delete_jobs(job["user_id"] for job in jobs)
+    return released
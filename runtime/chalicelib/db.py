@@ -1,7 +1,158 @@
+import calendar
 import os
-from typing import Union
+import random
+import time
+import uuid
+from collections import OrderedDict
+from typing import Union, Optional, Dict, Tuple, List, Iterable, Set, NamedTuple
 
 import boto3
+from boto3.dynamodb.conditions import Key
+
+from .utils import BloomFilter, pack_ids, unpack_ids
+
+TWITTER_LIMIT = 1000
+USER_LIMIT = 400
+# Every follow is reserved before it's made, and the limits are only enforced on the reservations: the app-wide
+# count of follows reserved today, and each user's. The "app" and per-user counters record the follows made.
+RESERVATIONS_KEY = "twitter-api"
+
+# Counters are kept per UTC day. Old days are never reset, DynamoDB's TTL on this attribute deletes them.
+QUOTA_WINDOW_SECONDS = 86400
+EXPIRES_AT = "expires_at"
+
+
+def quota_window(timestamp: Optional[float] = None) -> str:
+    if timestamp is None:
+        timestamp = time.time()
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+
+def quota_window_end(window: str) -> int:
+    return calendar.timegm(time.strptime(window, "%Y-%m-%d")) + QUOTA_WINDOW_SECONDS
+
+
+def counter_key(user_id: str, window: Optional[str] = None) -> str:
+    return f"{user_id}#{window or quota_window()}"
+
+
+def reservations_of(user_id: str) -> str:
+    """
+    The counter of the user's follows reserved today
+    """
+    return f"reserved#{user_id}"
+
+
+# Lockouts are shared by every container through the table. Each container caches what it read for a few seconds so
+# checking for a lockout doesn't cost a DynamoDB call per message.
+APP_SCOPE = "app"
+LOCKOUT_CACHE_SECONDS = 5.0
+
+
+def lockout_key(scope: str) -> str:
+    return f"lockout#{scope}"
+
+
+# Every follow adds to the app-wide counters, so each is spread over shards that are summed when read, instead of
+# every container writing to the same item. The number of shards can be raised but not lowered, or the counts in the
+# dropped shards are lost for the rest of the day.
+SHARDED_COUNTERS = (APP_SCOPE, RESERVATIONS_KEY)
+COUNTER_SHARDS = 10
+# how long a container trusts the app-wide totals it last summed
+TOTALS_CACHE_SECONDS = 2.0
+# follows kept back from TWITTER_LIMIT, for the ones made or reserved elsewhere since the totals were summed
+QUOTA_SAFETY_MARGIN = 10
+
+
+def shard_key(user_id: str, shard: int, window: Optional[str] = None) -> str:
+    return f"{counter_key(user_id, window)}#{shard}"
+
+
+def counter_shards() -> int:
+    return int(os.environ.get("APP_COUNTER_SHARDS", COUNTER_SHARDS))
+
+
+def quota_safety_margin() -> int:
+    return int(os.environ.get("APP_QUOTA_SAFETY_MARGIN", QUOTA_SAFETY_MARGIN))
+
+
+# How far a fan-out job has got through its list, so a retry or continuation can pick up where it stopped
+CHECKPOINT_SECONDS = 7 * 86400
+
+
+def checkpoint_key(job_id: str) -> str:
+    return f"fanout#{job_id}"
+
+
+def credentials_key(user_id: str) -> str:
+    return f"credentials#{user_id}"
+
+
+# Snapshots of a list's member ids, shared by everyone who asks to follow that list
+LIST_SNAPSHOT_SECONDS = 7 * 86400
+
+
+def list_snapshot_key(list_id: str) -> str:
+    return f"list#{list_id}"
+
+
+# The members already enqueued for a user from a list, so re-requesting the list only picks up new members
+SYNC_SECONDS = 90 * 86400
+
+
+def sync_key(user_id: str, list_id: str) -> str:
+    return f"sync#{user_id}#{list_id}"
+
+
+# Who each user has followed through us, so a job delivered or re-sent twice doesn't follow anyone twice. Each
+# container also keeps a Bloom filter per user of the follows it has recorded, so only a follow it may have seen
+# before costs a read of the ledger.
+FOLLOWED_SECONDS = 90 * 86400
+FOLLOWED_FILTER_USERS = 1024
+
+
+def followed_key(user_id: str, follower_id: str) -> str:
+    return f"followed#{user_id}#{follower_id}"
+
+
+# Jobs that have to wait longer than SQS can delay a message are parked in the table, on a sparse index by due time
+DELAYED_JOBS_INDEX = "due-index"
+DELAYED_JOBS_SHARD = "delayed"
+
+# When the next wake-up message is due, so containers don't arm one each
+WAKE_UP_KEY = "wake-up"
+
+# the most keys a single BatchGetItem can ask for
+BATCH_GET_LIMIT = 100
+
+
+class QuotaSnapshot(NamedTuple):
+    """
+    Today's counters and the lockouts of the app and some users, as read together at one moment. What's left is
+    what's left to reserve.
+    """
+
+    app_count: int
+    reserved: int
+    app_blocked_until: float
+    user_reserved: Dict[str, int]
+    user_blocked_until: Dict[str, float]
+    safety_margin: int = 0
+
+    @property
+    def app_left(self) -> int:
+        return TWITTER_LIMIT - self.safety_margin - self.reserved
+
+    def user_left(self, user_id: str) -> int:
+        return USER_LIMIT - self.user_reserved[user_id]
+
+    def blocked_until(self, scope: str = APP_SCOPE) -> float:
+        if scope == APP_SCOPE:
+            return self.app_blocked_until
+        return self.user_blocked_until[scope]
+
+    def locked_out(self, scope: str = APP_SCOPE) -> bool:
+        return time.time() < self.blocked_until(scope)
 
 
 class TwitterListDB(object):
@@ -20,12 +171,94 @@ class TwitterListDB(object):
     def update_item(self, user_id: str, attribute: str, updated_value: Union[int, str]):
         pass
 
+    def increment(self, user_id: str, amount: int = 1) -> int:
+        pass
+
+    def increase_counts(self, *user_ids: str, amount: int = 1):
+        pass
+
+    def quota_snapshot(
+        self,
+        user_ids: Iterable[str] = (),
+        window: Optional[str] = None,
+        fresh: bool = False,
+    ) -> QuotaSnapshot:
+        pass
+
+    def reserve_quota(self, user_id: str, n: int) -> int:
+        pass
+
+    def return_quota(self, user_id: str, n: int):
+        pass
+
+    def lock_out(self, until: float, scope: str = APP_SCOPE):
+        pass
+
+    def blocked_until(self, scope: str = APP_SCOPE) -> float:
+        pass
+
+    def locked_out(self, scope: str = APP_SCOPE) -> bool:
+        pass
+
+    def get_checkpoint(self, job_id: str) -> dict:
+        pass
+
+    def save_checkpoint(self, job_id: str, cursor: int, enqueued: int, done: bool):
+        pass
+
+    def save_credentials(
+        self, user_id: str, access_token: str, access_token_secret: str
+    ):
+        pass
+
+    def get_credentials(self, user_id: str) -> Optional[Dict[str, str]]:
+        pass
+
+    def get_list_snapshot(self, list_id: str, max_age: float) -> Optional[List[str]]:
+        pass
+
+    def save_list_snapshot(self, list_id: str, member_ids: Iterable[str]):
+        pass
+
+    def get_synced_members(self, user_id: str, list_id: str) -> Set[str]:
+        pass
+
+    def add_synced_members(self, user_id: str, list_id: str, member_ids: Iterable[str]):
+        pass
+
+    def claim_follow(self, user_id: str, follower_id: str) -> bool:
+        pass
+
+    def release_follow(self, user_id: str, follower_id: str):
+        pass
+
+    def defer_job(self, body: str, due_at: float) -> str:
+        pass
+
+    def due_jobs(self, now: Optional[float] = None, limit: int = 100) -> List[dict]:
+        pass
+
+    def delete_jobs(self, job_keys: Iterable[str]):
+        pass
+
+    def next_due_at(self) -> Optional[float]:
+        pass
+
+    def arm_wake_up(self, wake_at: float) -> bool:
+        pass
+
 
 class DynamoDBTwitterList(TwitterListDB):
     def __init__(self, table_resource):
         self._table = table_resource
-        self.add_item("app")
-        self.add_item("twitter-api")
+        # scope -> (blocked until, when we last read it)
+        self._lockouts: Dict[str, Tuple[float, float]] = {}
+        # counter key -> (total of its shards, when we last summed them)
+        self._totals: Dict[str, Tuple[int, float]] = {}
+        self._shards = counter_shards()
+        # user id -> the follows we've recorded for them, least recently used first
+        self._followed: "OrderedDict[str, BloomFilter]" = OrderedDict()
+        self._safety_margin = quota_safety_margin()
 
     def add_item(self, user_id: str):
         self._table.put_item(
@@ -52,27 +285,517 @@ class DynamoDBTwitterList(TwitterListDB):
         )
 
     def update_item(self, user_id: str, attribute: str, updated_value: Union[int, str]):
-        # We could also use update_item() with an UpdateExpression.
-        item = self.get_item(user_id)
-        item[attribute] = updated_value
-        self._table.put_item(Item=item)
-
-    def increase_count_by_one(self, user_id: str):
-        item = self.get_item(user_id)
-        item["count"] += 1
-        self._table.put_item(Item=item)
-
-    def reset_counts(self):
-        response = self._table.scan()
-        data = response["Items"]
-
-        while "LastEvaluatedKey" in response:
-            response = self._table.scan(ExclusiveStartKey=response["LastEvaluatedKey"])
-            data.extend(response["Items"])
-        for datum in data:
-            self.update_item(
-                user_id=datum["user_id"], attribute="count", updated_value=0
+        self._table.update_item(
+            Key={
+                "user_id": user_id,
+            },
+            UpdateExpression="SET #attribute = :value",
+            ExpressionAttributeNames={"#attribute": attribute},
+            ExpressionAttributeValues={":value": updated_value},
+        )
+
+    def _counter_key(self, user_id: str, window: str) -> str:
+        """
+        The item to add to for the user's counter: one of its shards, picked at random, if the counter is sharded
+        """
+        if user_id in SHARDED_COUNTERS:
+            return shard_key(user_id, random.randrange(self._shards), window)
+        return counter_key(user_id, window)
+
+    def _shard_keys(self, user_id: str, window: str) -> List[str]:
+        return [shard_key(user_id, shard, window) for shard in range(self._shards)]
+
+    def _counter_update(self, user_id: str, amount: int, window: Optional[str] = None):
+        """
+        The arguments for adding 'amount' to the user's counter for the current quota window
+        """
+        window = window or quota_window()
+        return dict(
+            Key={
+                "user_id": self._counter_key(user_id, window),
+            },
+            UpdateExpression="ADD #count :amount SET #expires_at = :expires_at",
+            ExpressionAttributeNames={"#count": "count", "#expires_at": EXPIRES_AT},
+            ExpressionAttributeValues={
+                ":amount": amount,
+                ":expires_at": quota_window_end(window) + QUOTA_WINDOW_SECONDS,
+            },
+        )
+
+    def _counted(self, user_ids: Iterable[str], amount: int, window: str):
+        # our own increments show up in the cached totals straight away
+        for user_id in user_ids:
+            cached = self._totals.get(counter_key(user_id, window))
+            if cached is not None:
+                self._totals[counter_key(user_id, window)] = (
+                    cached[0] + amount,
+                    cached[1],
+                )
+
+    def increment(self, user_id: str, amount: int = 1) -> int:
+        """
+        Adds 'amount' to the user's count for today on the server side and returns the new value. The counter is
+        created if it doesn't exist yet, and concurrent increments never overwrite each other. The new value of a
+        sharded counter is read back from all of its shards.
+        """
+        window = quota_window()
+        response = self._table.update_item(
+            **self._counter_update(user_id, amount, window),
+            ReturnValues="UPDATED_NEW",
+        )
+        self._counted([user_id], amount, window)
+        if user_id in SHARDED_COUNTERS:
+            return self.get_count(user_id, window)
+        return int(response["Attributes"]["count"])
+
+    def increase_counts(self, *user_ids: str, amount: int = 1):
+        """
+        Increments today's count of several users, e.g. a user and "app", in a single transaction
+        """
+        window = quota_window()
+        self._table.meta.client.transact_write_items(
+            TransactItems=[
+                {
+                    "Update": {
+                        "TableName": self._table.name,
+                        **self._counter_update(user_id, amount, window),
+                    }
+                }
+                for user_id in user_ids
+            ]
+        )
+        self._counted(user_ids, amount, window)
+
+    def get_count(self, user_id: str, window: Optional[str] = None) -> int:
+        window = window or quota_window()
+        if user_id in SHARDED_COUNTERS:
+            items = self._batch_get(self._shard_keys(user_id, window))
+            return sum(int(item.get("count", 0)) for item in items.values())
+        response = self._table.get_item(
+            Key={
+                "user_id": counter_key(user_id, window),
+            },
+            ConsistentRead=True,
+        )
+        return int(response.get("Item", {}).get("count", 0))
+
+    def _batch_get(self, keys: Iterable[str]) -> Dict[str, dict]:
+        """
+        The items under 'keys', read consistently, BATCH_GET_LIMIT keys to a request. Keys with no item are left out.
+        """
+        client = self._table.meta.client
+        keys = list(dict.fromkeys(keys))
+        items = {}
+        for start in range(0, len(keys), BATCH_GET_LIMIT):
+            request = {
+                self._table.name: {
+                    "Keys": [
+                        {"user_id": key}
+                        for key in keys[start : start + BATCH_GET_LIMIT]
+                    ],
+                    "ConsistentRead": True,
+                }
+            }
+            while request:
+                response = client.batch_get_item(RequestItems=request)
+                for item in response["Responses"].get(self._table.name, []):
+                    items[item["user_id"]] = item
+                # whatever DynamoDB didn't get to this time is asked for again
+                request = response.get("UnprocessedKeys")
+        return items
+
+    def quota_snapshot(
+        self,
+        user_ids: Iterable[str] = (),
+        window: Optional[str] = None,
+        fresh: bool = False,
+    ) -> QuotaSnapshot:
+        """
+        Today's follows and reservations, for the app and the given users, and their lockouts, in a single
+        BatchGetItem. The lockouts read also refresh the ones this container has cached. The app-wide totals are
+        summed from their shards and then trusted for TOTALS_CACHE_SECONDS, unless the snapshot has to be 'fresh'.
+        """
+        window = window or quota_window()
+        user_ids = list(dict.fromkeys(user_ids))
+        now = time.time()
+        totals: Dict[str, int] = {}
+        keys = [lockout_key(APP_SCOPE)]
+        for scope in SHARDED_COUNTERS:
+            cached = self._totals.get(counter_key(scope, window))
+            if (
+                not fresh
+                and cached is not None
+                and now - cached[1] < TOTALS_CACHE_SECONDS
+            ):
+                totals[scope] = cached[0]
+            else:
+                keys += self._shard_keys(scope, window)
+        items = self._batch_get(
+            keys
+            + [counter_key(reservations_of(user_id), window) for user_id in user_ids]
+            + [lockout_key(user_id) for user_id in user_ids]
+        )
+
+        def count(key: str) -> int:
+            return int(items.get(key, {}).get("count", 0))
+
+        for scope in SHARDED_COUNTERS:
+            if scope not in totals:
+                totals[scope] = sum(
+                    count(key) for key in self._shard_keys(scope, window)
+                )
+                self._totals[counter_key(scope, window)] = (totals[scope], now)
+
+        def blocked_until(scope: str) -> float:
+            until = float(items.get(lockout_key(scope), {}).get("blocked_until", 0))
+            self._lockouts[scope] = (until, now)
+            return until
+
+        return QuotaSnapshot(
+            app_count=totals[APP_SCOPE],
+            reserved=totals[RESERVATIONS_KEY],
+            app_blocked_until=blocked_until(APP_SCOPE),
+            user_reserved={
+                user_id: count(counter_key(reservations_of(user_id), window))
+                for user_id in user_ids
+            },
+            user_blocked_until={
+                user_id: blocked_until(user_id) for user_id in user_ids
+            },
+            safety_margin=self._safety_margin,
+        )
+
+    def _reservation_update(self, user_id: str, granted: int, limit: int, window: str):
+        update = self._counter_update(user_id, granted, window)
+        update[
+            "ConditionExpression"
+        ] = "attribute_not_exists(#count) OR #count <= :ceiling"
+        update["ExpressionAttributeValues"][":ceiling"] = limit - granted
+        return {"TableName": self._table.name, **update}
+
+    def reserve_quota(self, user_id: str, n: int, max_attempts: int = 5) -> int:
+        """
+        Reserves up to n of today's follows for the user, against both TWITTER_LIMIT and USER_LIMIT. Every follow is
+        reserved before it's made, so this is the one place either limit is enforced. The two reservation counters
+        are raised in one transaction that only succeeds if the user's wouldn't go over its limit, so concurrent
+        reservations can't hand out the same headroom of a user twice. The app-wide counter is sharded, so no single
+        item can guard it: reservations made at the same moment may share its last few follows, which the safety
+        margin leaves room for. Returns the number of follows granted, which may be 0.
+        """
+        client = self._table.meta.client
+        window = quota_window()
+        for _ in range(max_attempts):
+            snapshot = self.quota_snapshot([user_id], window, fresh=True)
+            granted = min(n, snapshot.app_left, snapshot.user_left(user_id))
+            if granted <= 0:
+                return 0
+            try:
+                client.transact_write_items(
+                    TransactItems=[
+                        {
+                            "Update": {
+                                "TableName": self._table.name,
+                                **self._counter_update(
+                                    RESERVATIONS_KEY, granted, window
+                                ),
+                            }
+                        },
+                        {
+                            "Update": self._reservation_update(
+                                reservations_of(user_id), granted, USER_LIMIT, window
+                            )
+                        },
+                    ]
+                )
+            except client.exceptions.TransactionCanceledException:
+                # someone else reserved in the meantime; re-read the counters and try again
+                continue
+            self._counted([RESERVATIONS_KEY], granted, window)
+            return granted
+        return 0
+
+    def return_quota(self, user_id: str, n: int):
+        """
+        Gives back n of the follows reserved for the user today that won't be made after all
+        """
+        if n > 0:
+            self.increase_counts(RESERVATIONS_KEY, reservations_of(user_id), amount=-n)
+
+    def increase_count_by_one(self, user_id: str) -> int:
+        return self.increment(user_id)
+
+    def lock_out(self, until: float, scope: str = APP_SCOPE):
+        """
+        Stops every worker from calling Twitter on behalf of 'scope' until the given timestamp. An existing lockout
+        that ends later is left as it is.
+        """
+        until = int(until)
+        try:
+            self._table.update_item(
+                Key={
+                    "user_id": lockout_key(scope),
+                },
+                UpdateExpression="SET #blocked_until = :until, #expires_at = :expires_at",
+                ConditionExpression="attribute_not_exists(#blocked_until) OR #blocked_until < :until",
+                ExpressionAttributeNames={
+                    "#blocked_until": "blocked_until",
+                    "#expires_at": EXPIRES_AT,
+                },
+                ExpressionAttributeValues={
+                    ":until": until,
+                    ":expires_at": until + QUOTA_WINDOW_SECONDS,
+                },
+            )
+        except self._table.meta.client.exceptions.ConditionalCheckFailedException:
+            # already locked out for longer; the next read will pick that up
+            self._lockouts.pop(scope, None)
+            return
+        self._lockouts[scope] = (until, time.time())
+
+    def blocked_until(self, scope: str = APP_SCOPE) -> float:
+        now = time.time()
+        cached = self._lockouts.get(scope)
+        if cached is not None and now - cached[1] < LOCKOUT_CACHE_SECONDS:
+            return cached[0]
+        response = self._table.get_item(
+            Key={
+                "user_id": lockout_key(scope),
+            },
+        )
+        until = float(response.get("Item", {}).get("blocked_until", 0))
+        self._lockouts[scope] = (until, now)
+        return until
+
+    def locked_out(self, scope: str = APP_SCOPE) -> bool:
+        return time.time() < self.blocked_until(scope)
+
+    def get_checkpoint(self, job_id: str) -> dict:
+        response = self._table.get_item(
+            Key={
+                "user_id": checkpoint_key(job_id),
+            },
+            ConsistentRead=True,
+        )
+        return response.get("Item", {})
+
+    def save_checkpoint(self, job_id: str, cursor: int, enqueued: int, done: bool):
+        self._table.put_item(
+            Item={
+                "user_id": checkpoint_key(job_id),
+                "cursor": cursor,
+                "enqueued": enqueued,
+                "done": done,
+                EXPIRES_AT: int(time.time()) + CHECKPOINT_SECONDS,
+            }
+        )
+
+    def save_credentials(
+        self, user_id: str, access_token: str, access_token_secret: str
+    ):
+        """
+        Keeps the user's access token, so follow jobs can refer to the user instead of carrying it
+        """
+        self._table.put_item(
+            Item={
+                "user_id": credentials_key(user_id),
+                "access_token": access_token,
+                "access_token_secret": access_token_secret,
+            }
+        )
+
+    def get_credentials(self, user_id: str) -> Optional[Dict[str, str]]:
+        response = self._table.get_item(
+            Key={
+                "user_id": credentials_key(user_id),
+            },
+        )
+        item = response.get("Item")
+        if item is None:
+            return None
+        return {
+            "access_token": item["access_token"],
+            "access_token_secret": item["access_token_secret"],
+        }
+
+    def get_list_snapshot(self, list_id: str, max_age: float) -> Optional[List[str]]:
+        """
+        The list's member ids, if we've fetched them within the last 'max_age' seconds
+        """
+        response = self._table.get_item(
+            Key={
+                "user_id": list_snapshot_key(list_id),
+            },
+        )
+        item = response.get("Item")
+        if item is None or time.time() - float(item["fetched_at"]) > max_age:
+            return None
+        return unpack_ids(item["members"].value)
+
+    def save_list_snapshot(self, list_id: str, member_ids: Iterable[str]):
+        now = int(time.time())
+        self._table.put_item(
+            Item={
+                "user_id": list_snapshot_key(list_id),
+                "members": pack_ids(member_ids),
+                "fetched_at": now,
+                EXPIRES_AT: now + LIST_SNAPSHOT_SECONDS,
+            }
+        )
+
+    def get_synced_members(self, user_id: str, list_id: str) -> Set[str]:
+        """
+        The members of the list we've already enqueued follow jobs for on behalf of the user
+        """
+        response = self._table.get_item(
+            Key={
+                "user_id": sync_key(user_id, list_id),
+            },
+            ConsistentRead=True,
+        )
+        item = response.get("Item")
+        if item is None:
+            return set()
+        return set(unpack_ids(item["members"].value))
+
+    def add_synced_members(self, user_id: str, list_id: str, member_ids: Iterable[str]):
+        """
+        Adds to the members of the list that have been enqueued for the user. A list is only fanned out by one
+        invocation at a time for a user, so this doesn't guard against concurrent writers.
+        """
+        members = self.get_synced_members(user_id, list_id)
+        members.update(member_ids)
+        self._table.put_item(
+            Item={
+                "user_id": sync_key(user_id, list_id),
+                "members": pack_ids(members),
+                EXPIRES_AT: int(time.time()) + SYNC_SECONDS,
+            }
+        )
+
+    def _followed_filter(self, user_id: str) -> BloomFilter:
+        followed = self._followed.get(user_id)
+        if followed is None:
+            followed = self._followed[user_id] = BloomFilter()
+            while len(self._followed) > FOLLOWED_FILTER_USERS:
+                self._followed.popitem(last=False)
+        else:
+            self._followed.move_to_end(user_id)
+        return followed
+
+    def claim_follow(self, user_id: str, follower_id: str) -> bool:
+        """
+        Records in the ledger that the user is following 'follower_id', unless that's already recorded. Returns
+        whether the caller should make the follow. The record is written with a condition, so of two workers
+        claiming the same follow only one gets it.
+        """
+        # jobs from before ids were packed may carry them as numbers
+        follower_id = str(follower_id)
+        followed = self._followed_filter(user_id)
+        if follower_id in followed:
+            # the filter may be wrong about this one, so check the ledger
+            response = self._table.get_item(
+                Key={
+                    "user_id": followed_key(user_id, follower_id),
+                },
+                ConsistentRead=True,
+            )
+            if "Item" in response:
+                return False
+        try:
+            self._table.put_item(
+                Item={
+                    "user_id": followed_key(user_id, follower_id),
+                    EXPIRES_AT: int(time.time()) + FOLLOWED_SECONDS,
+                },
+                ConditionExpression="attribute_not_exists(user_id)",
+            )
+        except self._table.meta.client.exceptions.ConditionalCheckFailedException:
+            followed.add(follower_id)
+            return False
+        followed.add(follower_id)
+        return True
+
+    def release_follow(self, user_id: str, follower_id: str):
+        """
+        Takes back a claim on a follow that didn't happen, so it can be claimed again when it's retried
+        """
+        self._table.delete_item(
+            Key={
+                "user_id": followed_key(user_id, follower_id),
+            }
+        )
+
+    def defer_job(self, body: str, due_at: float) -> str:
+        """
+        Parks a job's message body until 'due_at'. Returns the key it was stored under.
+        """
+        job_key = f"delayed#{uuid.uuid4()}"
+        self._table.put_item(
+            Item={
+                "user_id": job_key,
+                "job_shard": DELAYED_JOBS_SHARD,
+                "due_at": int(due_at),
+                "body": body,
+            }
+        )
+        return job_key
+
+    def due_jobs(self, now: Optional[float] = None, limit: int = 100) -> List[dict]:
+        """
+        Up to 'limit' parked jobs that are due, earliest first
+        """
+        if now is None:
+            now = time.time()
+        response = self._table.query(
+            IndexName=DELAYED_JOBS_INDEX,
+            KeyConditionExpression=Key("job_shard").eq(DELAYED_JOBS_SHARD)
+            & Key("due_at").lte(int(now)),
+            Limit=limit,
+        )
+        return response["Items"]
+
+    def delete_jobs(self, job_keys: Iterable[str]):
+        with self._table.batch_writer() as batch:
+            for job_key in job_keys:
+                batch.delete_item(Key={"user_id": job_key})
+
+    def next_due_at(self) -> Optional[float]:
+        """
+        When the earliest parked job is due, or None if nothing is parked
+        """
+        response = self._table.query(
+            IndexName=DELAYED_JOBS_INDEX,
+            KeyConditionExpression=Key("job_shard").eq(DELAYED_JOBS_SHARD),
+            Limit=1,
+        )
+        if not response["Items"]:
+            return None
+        return float(response["Items"][0]["due_at"])
+
+    def arm_wake_up(self, wake_at: float) -> bool:
+        """
+        Records that a wake-up is due at 'wake_at', unless one that's due sooner is still to come. Returns whether
+        the caller should send the wake-up.
+        """
+        wake_at = int(wake_at)
+        try:
+            self._table.update_item(
+                Key={
+                    "user_id": WAKE_UP_KEY,
+                },
+                UpdateExpression="SET #wake_at = :wake_at",
+                ConditionExpression="attribute_not_exists(#wake_at) OR #wake_at > :wake_at OR #wake_at <= :now",
+                ExpressionAttributeNames={
+                    "#wake_at": "wake_at",
+                },
+                ExpressionAttributeValues={
+                    ":wake_at": wake_at,
+                    ":now": int(time.time()),
+                },
             )
+        except self._table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
 
     @staticmethod
     def get_app_db():
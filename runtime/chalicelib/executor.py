@@ -0,0 +1,40 @@
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Iterable, List, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def run_in_lanes(
+    items: Iterable[T],
+    lane: Callable[[T], Hashable],
+    work: Callable[[T], None],
+    max_workers: int,
+) -> List[T]:
+    """
+    Runs 'work' on every item, with the items of each lane one after another and up to 'max_workers' lanes at once.
+    Follows for one user share a lane, so they keep that user's lockouts in order, while different users don't wait
+    for each other. Returns the items 'work' finished without raising, in no particular order.
+    """
+    lanes: Dict[Hashable, List[T]] = defaultdict(list)
+    for item in items:
+        lanes[lane(item)].append(item)
+
+    def run_lane(lane_items: List[T]) -> List[T]:
+        done = []
+        for item in lane_items:
+            try:
+                work(item)
+            except Exception:
+                logger.exception("Failed to process %r", item)
+                continue
+            done.append(item)
+        return done
+
+    if not lanes:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(lanes))) as pool:
+        return [item for done in pool.map(run_lane, lanes.values()) for item in done]
@@ -1,8 +1,225 @@
+import math
 import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Mapping, List, Iterable, Callable, Tuple
+
 import boto3
 from . import db
+from .utils import encode_ids, decode_ids
 import tweepy
 
+DAY_SECONDS = 86400
+RETRY_SECONDS = 900
+# the longest SQS will hide a message for
+MAX_DELAY_SECONDS = 900
+
+# Who a failed follow should stop following for a while
+USER_SCOPE = "user"
+APP_SCOPE = db.APP_SCOPE
+
+# Twitter API error codes, see https://developer.twitter.com/en/support/twitter-api/error-troubleshooting
+RATE_LIMIT_EXCEEDED = 88
+COULD_NOT_AUTHENTICATE = 32
+INVALID_OR_EXPIRED_TOKEN = 89
+ACCOUNT_SUSPENDED = 64
+FOLLOW_LIMIT_REACHED = 161
+ACCOUNT_TEMPORARILY_LOCKED = 326
+APP_SUSPENDED = 416
+APP_CANNOT_WRITE = 261
+USER_NOT_FOUND = (50, 108)
+USER_SUSPENDED = 63
+ALREADY_REQUESTED = 160
+BLOCKED_FROM_FOLLOWING = 162
+OVER_CAPACITY = 130
+INTERNAL_ERROR = 131
+
+USER_LOCKOUT_CODES = {
+    RATE_LIMIT_EXCEEDED,
+    COULD_NOT_AUTHENTICATE,
+    INVALID_OR_EXPIRED_TOKEN,
+    ACCOUNT_SUSPENDED,
+    FOLLOW_LIMIT_REACHED,
+    ACCOUNT_TEMPORARILY_LOCKED,
+}
+APP_LOCKOUT_CODES = {APP_SUSPENDED, APP_CANNOT_WRITE}
+# these are about the account being followed, so trying again won't help
+GIVE_UP_CODES = {
+    *USER_NOT_FOUND,
+    USER_SUSPENDED,
+    ALREADY_REQUESTED,
+    BLOCKED_FROM_FOLLOWING,
+}
+TRANSIENT_CODES = {OVER_CAPACITY, INTERNAL_ERROR}
+
+
+class RateLimit(NamedTuple):
+    remaining: int
+    # when the window resets, in seconds since the epoch
+    reset: float
+
+
+def rate_limit_from_response(response) -> Optional[RateLimit]:
+    """
+    Reads Twitter's x-rate-limit-* headers from a tweepy response, if there are any
+    """
+    headers = getattr(response, "headers", None)
+    if not isinstance(headers, Mapping):
+        return None
+    try:
+        return RateLimit(
+            int(headers["x-rate-limit-remaining"]),
+            float(headers["x-rate-limit-reset"]),
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def delay_until(until: float) -> int:
+    """
+    The DelaySeconds that brings a message back as close to 'until' as SQS allows
+    """
+    return min(max(math.ceil(until - time.time()), 0), MAX_DELAY_SECONDS)
+
+
+class Lockout(NamedTuple):
+    # USER_SCOPE, APP_SCOPE or None if nobody needs to stop
+    scope: Optional[str]
+    seconds: float
+    # whether the follow should be tried again later
+    retry: bool
+
+
+def lockout_for_error(error: tweepy.TweepError) -> Lockout:
+    """
+    Decides what a failed follow means for everyone else. Hitting a rate or follow limit, or a problem with the
+    user's credentials, only stops that user; a problem with the app's credentials stops the app. Errors about the
+    account being followed stop nobody and aren't retried. If Twitter told us when the rate limit resets, the lockout
+    lasts exactly until then.
+    """
+    status_code = getattr(error.response, "status_code", None)
+    rate_limit = rate_limit_from_response(error.response)
+    seconds = DAY_SECONDS
+    if rate_limit is not None and rate_limit.reset > time.time():
+        seconds = rate_limit.reset - time.time()
+    if error.api_code in APP_LOCKOUT_CODES:
+        return Lockout(APP_SCOPE, seconds, True)
+    if (
+        isinstance(error, tweepy.RateLimitError)
+        or error.api_code in USER_LOCKOUT_CODES
+        or status_code == 429
+    ):
+        return Lockout(USER_SCOPE, seconds, True)
+    if error.api_code in GIVE_UP_CODES:
+        return Lockout(None, 0, False)
+    if error.api_code in TRANSIENT_CODES or (status_code or 0) >= 500:
+        return Lockout(None, 0, True)
+    return Lockout(USER_SCOPE, RETRY_SECONDS, True)
+
+
+# How many people one follow job asks to follow; a job message stays a few kilobytes at most
+FOLLOWERS_PER_JOB = 200
+# What a request carries to act on the requester's behalf; follow jobs look it up by user_id instead
+CREDENTIAL_KEYS = ("access_token", "access_token_secret")
+
+
+def follow_job(job: dict, follower_ids: Iterable[str]) -> dict:
+    """
+    A job asking to follow 'follower_ids' on behalf of the user in 'job'. Jobs made from old single-follower messages
+    keep their credentials.
+    """
+    job = {
+        key: value
+        for key, value in job.items()
+        if key not in ("follower_id", "follower_ids")
+    }
+    return {**job, "follower_ids": encode_ids(follower_ids)}
+
+
+def job_follower_ids(job: dict) -> List[str]:
+    """
+    Who a follow job asks to follow. Jobs enqueued before they were batched carry a single 'follower_id'.
+    """
+    if "follower_ids" in job:
+        return decode_ids(job["follower_ids"])
+    return [job["follower_id"]]
+
+
+# Jobs whose follows have been reserved say for which day, so they aren't reserved again that day
+RESERVED_FOR = "reserved_for"
+
+
+def reserved_job(job: dict, reserved: bool = True) -> dict:
+    """
+    The job, marked as having its follows reserved today, or with the mark taken off
+    """
+    job = {key: value for key, value in job.items() if key != RESERVED_FOR}
+    if reserved:
+        job[RESERVED_FOR] = db.quota_window()
+    return job
+
+
+def job_reserved(job: dict) -> bool:
+    return job.get(RESERVED_FOR) == db.quota_window()
+
+
+# How many authenticated clients a warm container keeps, and for how long
+API_CACHE_SIZE = 256
+API_CACHE_SECONDS = 900
+
+
+class CachedApi(object):
+    """
+    An authenticated client, and whose it is once someone has asked
+    """
+
+    def __init__(self, api: tweepy.API, created_at: float):
+        self.api = api
+        self.created_at = created_at
+        self._user_id: Optional[str] = None
+
+    def user_id(self) -> str:
+        if self._user_id is None:
+            self._user_id = self.api.me().id_str
+        return self._user_id
+
+
+class ApiCache(object):
+    """
+    Keeps the most recently used authenticated clients by access token, so a warm container doesn't set one up, or
+    ask Twitter who it belongs to, for every job. Clients are dropped after 'ttl' seconds, and the least recently
+    used one goes when there are more than 'max_size'.
+    """
+
+    def __init__(self, max_size: int = API_CACHE_SIZE, ttl: float = API_CACHE_SECONDS):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries: "OrderedDict[Tuple[str, ...], CachedApi]" = OrderedDict()
+        # the drain uses it from several threads
+        self._lock = threading.Lock()
+
+    def get(
+        self, credentials: Mapping[str, str], build: Callable[[], tweepy.API]
+    ) -> CachedApi:
+        key = tuple(credentials[key] for key in CREDENTIAL_KEYS)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry.created_at < self._ttl:
+                self._entries.move_to_end(key)
+                return entry
+            entry = CachedApi(build(), now)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+            return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 
 class ProcessFollow:
     def __init__(self):
@@ -0,0 +1,78 @@
+import json
+from typing import Dict, List, Mapping, NamedTuple, Tuple
+
+from .process_follow import follow_job, job_follower_ids
+
+# follows a user is offered each round
+QUANTUM = 10
+
+
+class Job(NamedTuple):
+    """
+    A follow job drawn from the 'do later' queue: who it's for, the message as it came, and who it asks to follow
+    """
+
+    user_id: str
+    body: str
+    follower_ids: List[str]
+
+    @classmethod
+    def from_body(cls, body: str) -> "Job":
+        job = json.loads(body)
+        return cls(job["user_id"], body, job_follower_ids(job))
+
+    def only(self, follower_ids: List[str]) -> "Job":
+        """
+        The same job, asking to follow just 'follower_ids'
+        """
+        body = json.dumps(follow_job(json.loads(self.body), follower_ids))
+        return Job(self.user_id, body, follower_ids)
+
+
+def deficit_round_robin(
+    demands: Mapping[str, int], capacity: int, quantum: int = QUANTUM
+) -> Dict[str, int]:
+    """
+    Shares 'capacity' follows between users by deficit round robin. Each round every user who still wants more is
+    offered 'quantum' follows on top of whatever they couldn't use last round, and rounds go on until the capacity or
+    the demand runs out. A user who asks for a little gets all of it before a user who asks for a lot gets more than
+    their turn. Users are served in the order of 'demands'. Returns how many follows each user gets.
+    """
+    shares = {user_id: 0 for user_id in demands}
+    deficits = {user_id: 0 for user_id in demands}
+    waiting = [user_id for user_id, demand in demands.items() if demand > 0]
+    while capacity > 0 and waiting:
+        for user_id in list(waiting):
+            deficits[user_id] += quantum
+            granted = min(
+                deficits[user_id], demands[user_id] - shares[user_id], capacity
+            )
+            shares[user_id] += granted
+            deficits[user_id] -= granted
+            capacity -= granted
+            if shares[user_id] == demands[user_id]:
+                waiting.remove(user_id)
+            if capacity == 0:
+                break
+    return shares
+
+
+def split_by_share(
+    jobs: List[Job], shares: Mapping[str, int]
+) -> Tuple[List[Job], List[Job]]:
+    """
+    Splits each user's jobs, in order, into the follows they get now and the ones left over. A job that straddles the
+    user's share is split in two.
+    """
+    left = dict(shares)
+    scheduled, leftover = [], []
+    for job in jobs:
+        now = job.follower_ids[: max(left.get(job.user_id, 0), 0)]
+        left[job.user_id] = left.get(job.user_id, 0) - len(now)
+        if len(now) == len(job.follower_ids):
+            scheduled.append(job)
+            continue
+        if now:
+            scheduled.append(job.only(now))
+        leftover.append(job.only(job.follower_ids[len(now) :]) if now else job)
+    return scheduled, leftover
@@ -1,27 +1,274 @@
+import base64
+import hashlib
+import itertools
 import os
-import time
-from typing import Tuple
+import struct
+import zlib
+from itertools import islice
+from typing import Tuple, Iterable, Iterator, List, Dict, Optional, Union
 
 import boto3
+from botocore.exceptions import ClientError
 
 sqs = boto3.resource("sqs")
 
+QUEUE_NAME_VARIABLES = {
+    "now": "APP_DO_NOW_QUEUE_NAME",
+    "later": "APP_DO_LATER_QUEUE_NAME",
+    "process": "APP_PROCESS_QUEUE_NAME",
+    "wake": "APP_WAKE_QUEUE_NAME",
+}
+QUEUE_DOES_NOT_EXIST_CODES = (
+    "AWS.SimpleQueueService.NonExistentQueue",
+    "QueueDoesNotExist",
+)
 
-def get_queue_url(queue_name: str):
-    sqs_client = boto3.client("sqs")
-    response = sqs_client.get_queue_url(
+# SQS accepts at most ten entries per SendMessageBatch / DeleteMessageBatch request
+SQS_BATCH_SIZE = 10
+
+
+def get_queue_url(queue_name: str, sqs_resource=sqs):
+    response = sqs_resource.meta.client.get_queue_url(
         QueueName=queue_name,
     )
     return response["QueueUrl"]
 
 
-def queues() -> Tuple[sqs.Queue, sqs.Queue, sqs.Queue]:
+class QueueRegistry(object):
+    """
+    Resolves the app's queues by logical name ("now", "later" or "process") and keeps them for the lifetime of the
+    process, so a warm Lambda container only calls get_queue_url once per queue. Every queue shares the one SQS
+    resource and its connection pool.
+    """
+
+    def __init__(self, sqs_resource=sqs):
+        self._sqs = sqs_resource
+        self._queues: Dict[str, sqs.Queue] = {}
+
+    @staticmethod
+    def queue_name(name: str) -> str:
+        return os.environ.get(QUEUE_NAME_VARIABLES[name], "")
+
+    def get(self, name: str) -> "RegisteredQueue":
+        return RegisteredQueue(self, name)
+
+    def resolve(self, name: str) -> sqs.Queue:
+        queue_name = self.queue_name(name)
+        if queue_name not in self._queues:
+            self._queues[queue_name] = self._sqs.Queue(
+                get_queue_url(queue_name, self._sqs)
+            )
+        return self._queues[queue_name]
+
+    def invalidate(self, name: str):
+        self._queues.pop(self.queue_name(name), None)
+
+
+class RegisteredQueue(object):
+    """
+    Stands in for an sqs.Queue. If a call fails because the queue no longer exists, e.g. it was recreated by a
+    deployment, the URL is looked up again and the call is retried once.
+    """
+
+    def __init__(self, registry: QueueRegistry, name: str):
+        self._registry = registry
+        self._name = name
+
+    def __getattr__(self, attribute: str):
+        value = getattr(self._registry.resolve(self._name), attribute)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            try:
+                return value(*args, **kwargs)
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in QUEUE_DOES_NOT_EXIST_CODES:
+                    raise
+                self._registry.invalidate(self._name)
+                retry = getattr(self._registry.resolve(self._name), attribute)
+                return retry(*args, **kwargs)
+
+        return call
+
+
+_REGISTRY = QueueRegistry()
+
+
+def queue(name: str) -> RegisteredQueue:
+    return _REGISTRY.get(name)
+
+
+def queues() -> Tuple[RegisteredQueue, RegisteredQueue, RegisteredQueue]:
+    return queue("now"), queue("later"), queue("process")
+
+
+def queue_backlog(sqs_queue: RegisteredQueue) -> Tuple[int, int]:
+    """
+    Roughly how many messages are waiting on the queue: those that can be received now, and those still delayed
+    """
+    sqs_queue.load()
+    attributes = sqs_queue.attributes
     return (
-        sqs.Queue(get_queue_url(os.environ.get("APP_DO_NOW_QUEUE_NAME", ""))),
-        sqs.Queue(get_queue_url(os.environ.get("APP_DO_LATER_QUEUE_NAME", ""))),
-        sqs.Queue(get_queue_url(os.environ.get("APP_PROCESS_QUEUE_NAME", ""))),
+        int(attributes.get("ApproximateNumberOfMessages", 0)),
+        int(attributes.get("ApproximateNumberOfMessagesDelayed", 0)),
+    )
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def receive_wait_seconds() -> int:
+    """
+    How long receive_messages long-polls for; an empty receive then really means the queue is empty
+    """
+    return int(os.environ.get("APP_RECEIVE_WAIT_SECONDS", 20))
+
+
+def follows_in_flight() -> int:
+    """
+    How many follow requests the drain makes at once, each for a different user
+    """
+    return int(os.environ.get("APP_FOLLOWS_IN_FLIGHT", 10))
+
+
+def deadline_margin_ms() -> int:
+    """
+    How close to its timeout an invocation stops taking on new work
+    """
+    return int(os.environ.get("APP_DEADLINE_MARGIN_MS", 30000))
+
+
+def seconds_left(context) -> Optional[float]:
+    """
+    How long the Lambda invocation has until it's within the deadline margin of its timeout, or None without a
+    context, when there's no deadline
+    """
+    get_remaining_time = getattr(context, "get_remaining_time_in_millis", None)
+    if get_remaining_time is None:
+        return None
+    return (get_remaining_time() - deadline_margin_ms()) / 1000
+
+
+def running_out_of_time(context) -> bool:
+    """
+    Whether the Lambda invocation is within the deadline margin of its timeout. Without a context there's no deadline.
+    """
+    left = seconds_left(context)
+    return left is not None and left < 0
+
+
+def delete_messages_in_batches(queue: RegisteredQueue, receipt_handles: Iterable[str]):
+    for batch in chunked(receipt_handles, SQS_BATCH_SIZE):
+        queue.delete_messages(
+            Entries=[
+                {"Id": str(i), "ReceiptHandle": receipt_handle}
+                for i, receipt_handle in enumerate(batch)
+            ]
+        )
+
+
+def unsent_messages(
+    queue: RegisteredQueue, message_bodies: Iterable[str], max_attempts: int = 3
+) -> List[int]:
+    """
+    Sends message bodies to the queue ten at a time. If SQS rejects some of the entries in a batch, only those entries
+    are sent again, up to max_attempts times. Returns the positions of the bodies that still weren't sent, so the
+    caller can keep whatever they stood for.
+    """
+    unsent = []
+    for start, batch in zip(
+        itertools.count(0, SQS_BATCH_SIZE), chunked(message_bodies, SQS_BATCH_SIZE)
+    ):
+        entries = [
+            {"Id": str(start + i), "MessageBody": body} for i, body in enumerate(batch)
+        ]
+        for _ in range(max_attempts):
+            response = queue.send_messages(Entries=entries)
+            retryable = {
+                failure["Id"]
+                for failure in response.get("Failed", [])
+                if not failure.get("SenderFault", False)
+            }
+            sent = {success["Id"] for success in response.get("Successful", [])}
+            unsent.extend(
+                int(entry["Id"])
+                for entry in entries
+                if entry["Id"] not in sent and entry["Id"] not in retryable
+            )
+            entries = [entry for entry in entries if entry["Id"] in retryable]
+            if not entries:
+                break
+        unsent.extend(int(entry["Id"]) for entry in entries)
+    return sorted(unsent)
+
+
+def send_messages_in_batches(
+    queue: RegisteredQueue, message_bodies: Iterable[str], max_attempts: int = 3
+) -> int:
+    """
+    Sends message bodies to the queue like 'unsent_messages'. Returns the number of messages that were enqueued.
+    """
+    message_bodies = list(message_bodies)
+    return len(message_bodies) - len(
+        unsent_messages(queue, message_bodies, max_attempts)
     )
 
 
-def locked_out():
-    return float(time.time()) < float(os.environ.get("BLOCKED_UNTIL", 0.0))
+def pack_ids(ids: Iterable[Union[str, int]]) -> bytes:
+    """
+    Packs Twitter user ids into a compact blob: the distinct ids, sorted, as 64-bit integers, compressed
+    """
+    values = sorted({int(i) for i in ids})
+    return zlib.compress(struct.pack(f"<{len(values)}Q", *values))
+
+
+def unpack_ids(packed: bytes) -> List[str]:
+    data = zlib.decompress(packed)
+    return [str(value) for value in struct.unpack(f"<{len(data) // 8}Q", data)]
+
+
+def encode_ids(ids: Iterable[Union[str, int]]) -> str:
+    """
+    Packs user ids into text that fits in a JSON message
+    """
+    return base64.b64encode(pack_ids(ids)).decode("ascii")
+
+
+def decode_ids(encoded: str) -> List[str]:
+    return unpack_ids(base64.b64decode(encoded))
+
+
+class BloomFilter(object):
+    """
+    A set of strings that fits in a fixed number of bits. It never forgets a string it was given, but may claim to
+    hold one it wasn't, more often the fuller it gets. With the defaults, up to a thousand strings are held with
+    about one false positive in a thousand.
+    """
+
+    def __init__(self, bits: int = 16384, hashes: int = 7):
+        self._bits = bytearray(bits // 8)
+        self._size = len(self._bits) * 8
+        self._hashes = hashes
+
+    def _positions(self, value: str) -> Iterator[int]:
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        first, second = struct.unpack("<QQ", digest)
+        for i in range(self._hashes):
+            yield (first + i * second) % self._size
+
+    def add(self, value: str):
+        for position in self._positions(value):
+            self._bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, value: str) -> bool:
+        return all(
+            self._bits[position // 8] & (1 << (position % 8))
+            for position in self._positions(value)
+        )
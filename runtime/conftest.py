@@ -8,6 +8,7 @@ from chalice.test import Client
 from moto import mock_sqs, mock_dynamodb2
 from pytest import fixture
 
+import app as app_module
 from app import app
 from tests.utils.tweepy_stub import TweepyStub
 
@@ -21,17 +22,34 @@ def mock_settings_env_vars():
             "APP_DO_NOW_QUEUE_NAME": "test-now-queue",
             "APP_DO_LATER_QUEUE_NAME": "test-later-queue",
             "APP_PROCESS_QUEUE_NAME": "test-process",
+            "APP_WAKE_QUEUE_NAME": "test-wake-queue",
+            "APP_RECEIVE_WAIT_SECONDS": "0",
+            "APP_DEADLINE_MARGIN_MS": "1000",
+            "APP_QUOTA_SAFETY_MARGIN": "0",
             "AWS_ACCESS_KEY_ID": "testing",
             "AWS_SECRET_ACCESS_KEY": "testing",
             "AWS_SECURITY_TOKEN": "testing",
             "AWS_SESSION_TOKEN": "testing",
             "AWS_DEFAULT_REGION": "us-east-1",
-            "BLOCKED_UNTIL": "0.0",
         },
     ):
         yield
 
 
+@fixture(autouse=True)
+def clear_api_cache():
+    # clients cached by one test would otherwise outlive its patches
+    app_module.api_cache.clear()
+    yield
+    app_module.api_cache.clear()
+
+
+@fixture(autouse=True)
+def mock_wake_up_queue():
+    with patch("app.wake_up_queue") as wake_up_queue:
+        yield wake_up_queue.return_value
+
+
 @fixture(scope="function")
 def mock_sqs_resource(mock_settings_env_vars):
     with mock_sqs():
@@ -52,17 +70,29 @@ def mock_db(mock_settings_env_vars, mock_dynamo_resource):
         TableName="TestAppTable",
         AttributeDefinitions=[
             {"AttributeName": "user_id", "AttributeType": "S"},
+            {"AttributeName": "job_shard", "AttributeType": "S"},
+            {"AttributeName": "due_at", "AttributeType": "N"},
         ],
         KeySchema=[
             {"AttributeName": "user_id", "KeyType": "HASH"},
         ],
+        GlobalSecondaryIndexes=[
+            {
+                "IndexName": "due-index",
+                "KeySchema": [
+                    {"AttributeName": "job_shard", "KeyType": "HASH"},
+                    {"AttributeName": "due_at", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "ALL"},
+            }
+        ],
     )
     test_db = DynamoDBTwitterList(test_table)
     test_db.add_item("123")
     test_db.add_item("app")
     test_db.add_item("twitter-api")
     with patch("app.get_app_db", return_value=test_db):
-        yield
+        yield test_db
 
 
 @fixture(scope="function")
@@ -73,6 +103,8 @@ def test_client():
 
 @fixture(scope="function")
 def mocked_tweepy():
+    # the app-wide count is shared by every stub, so start each test from zero
+    TweepyStub.app_count = 0
     yield TweepyStub("123")
 
 
@@ -0,0 +1,314 @@
+import pytest
+
+import datetime
+from unittest.mock import patch
+
+from chalicelib.db import (
+    COUNTER_SHARDS,
+    RESERVATIONS_KEY,
+    counter_key,
+    reservations_of,
+    DynamoDBTwitterList,
+)
+
+
+class TestCounters:
+    def test_increment_returns_new_value(self, mock_db):
+        assert mock_db.increment("123") == 1
+        assert mock_db.increment("123", amount=5) == 6
+        assert mock_db.get_count("123") == 6
+
+    def test_increment_creates_missing_item(self, mock_db):
+        assert mock_db.increment("new-user") == 1
+
+    def test_increase_counts_updates_every_item(self, mock_db):
+        mock_db.increase_counts("123", "app")
+        mock_db.increase_counts("123", "app")
+        assert mock_db.get_count("123") == 2
+        assert mock_db.get_count("app") == 2
+        assert mock_db.get_count("twitter-api") == 0
+
+    def test_counters_start_again_each_day(self, mock_db, frozen_time):
+        mock_db.increase_counts("123", "app", amount=400)
+        frozen_time.tick(datetime.timedelta(hours=23, minutes=59))
+        assert mock_db.get_count("123") == 400
+        frozen_time.tick(datetime.timedelta(minutes=1))
+        assert mock_db.get_count("123") == 0
+        assert mock_db.increment("123") == 1
+        assert mock_db.get_count("123", "2021-05-01") == 400
+
+    def test_counters_expire_after_their_window(self, mock_db):
+        mock_db.increment("123")
+        item = mock_db.get_item(counter_key("123"))
+        assert item["user_id"] == "123#2021-05-01"
+        # 2021-05-03 00:00:00 UTC, a day after the window closes
+        assert item["expires_at"] == 1620000000
+
+    def test_update_item_keeps_other_attributes(self, mock_db):
+        mock_db.update_item("123", "screen_name", "someone")
+        mock_db.update_item("123", "count", 3)
+        assert mock_db.get_item("123") == {
+            "user_id": "123",
+            "count": 3,
+            "screen_name": "someone",
+        }
+
+
+class TestReserveQuota:
+    @pytest.mark.parametrize(
+        "all_requests, user_requests, requested, expected",
+        [
+            (0, 0, 2, 2),
+            (1000, 0, 2, 0),
+            (0, 400, 2, 0),
+            (1000, 400, 2, 0),
+            (995, 0, 10, 5),
+            (0, 390, 50, 10),
+        ],
+    )
+    def test_reservation_is_capped_by_both_limits(
+        self, mock_db, all_requests, user_requests, requested, expected
+    ):
+        mock_db.increment(RESERVATIONS_KEY, amount=all_requests)
+        mock_db.increment(reservations_of("123"), amount=user_requests)
+        assert mock_db.reserve_quota("123", requested) == expected
+        assert mock_db.get_count(RESERVATIONS_KEY) == all_requests + expected
+        assert mock_db.get_count(reservations_of("123")) == user_requests + expected
+
+    def test_reservations_add_to_the_counters(self, mock_db):
+        for _ in range(3):
+            assert mock_db.reserve_quota("123", 150) in (150, 100)
+        assert mock_db.get_count(reservations_of("123")) == 400
+        assert mock_db.get_count(RESERVATIONS_KEY) == 400
+        assert mock_db.reserve_quota("123", 1) == 0
+
+    def test_reservation_is_retried_when_counters_change(self, mock_db):
+        quota_snapshot = mock_db.quota_snapshot
+        calls = []
+
+        def racing_quota_snapshot(user_ids=(), window=None, fresh=False):
+            calls.append(list(user_ids))
+            snapshot = quota_snapshot(calls[-1], window, fresh)
+            if len(calls) == 1:
+                # another enqueue reserves all but one of the user's follows after we've read the counters
+                mock_db.increment(reservations_of("123"), amount=399)
+            return snapshot
+
+        mock_db.quota_snapshot = racing_quota_snapshot
+        assert mock_db.reserve_quota("123", 5) == 1
+        assert calls == [["123"], ["123"]]
+        assert mock_db.get_count(reservations_of("123")) == 400
+
+    def test_follows_made_do_not_use_up_reservations(self, mock_db):
+        mock_db.reserve_quota("123", 400)
+        mock_db.increase_counts("123", "app", amount=400)
+        assert mock_db.quota_snapshot(["123"]).user_left("123") == 0
+        mock_db.return_quota("123", 30)
+        assert mock_db.reserve_quota("123", 50) == 30
+        assert mock_db.get_count("123") == 400
+
+
+class TestQuotaSnapshot:
+    def test_snapshot_reads_counters_and_lockouts(self, mock_db, frozen_time):
+        now = frozen_time().timestamp()
+        mock_db.increase_counts("123", "app", amount=3)
+        mock_db.reserve_quota("123", 7)
+        mock_db.lock_out(now + 60, scope="456")
+        snapshot = mock_db.quota_snapshot(["123", "456"])
+        assert snapshot.app_count == 3
+        assert snapshot.app_left == 993
+        assert snapshot.reserved == 7
+        assert snapshot.user_reserved == {"123": 7, "456": 0}
+        assert snapshot.user_left("456") == 400
+        assert not snapshot.locked_out()
+        assert not snapshot.locked_out("123")
+        assert snapshot.blocked_until("456") == now + 60
+
+    def test_snapshot_is_a_single_batch_get(self, mock_db):
+        client = mock_db._table.meta.client
+        with patch.object(
+            client, "batch_get_item", wraps=client.batch_get_item
+        ) as batch_get_item, patch.object(
+            client, "get_item", wraps=client.get_item
+        ) as get_item:
+            mock_db.quota_snapshot(["123", "456"])
+        batch_get_item.assert_called_once()
+        (request,) = batch_get_item.call_args.kwargs["RequestItems"].values()
+        assert request["ConsistentRead"]
+        # the app's lockout, both app-wide counters' shards, and each user's reservations and lockout
+        assert len(request["Keys"]) == 1 + 2 * COUNTER_SHARDS + 4
+        get_item.assert_not_called()
+
+    def test_many_users_are_read_in_batches(self, mock_db):
+        client = mock_db._table.meta.client
+        users = [str(user_id) for user_id in range(60)]
+        mock_db.increment(reservations_of("59"), amount=2)
+        with patch.object(
+            client, "batch_get_item", wraps=client.batch_get_item
+        ) as batch_get_item:
+            snapshot = mock_db.quota_snapshot(users)
+        assert batch_get_item.call_count == 2
+        assert snapshot.user_reserved["59"] == 2
+
+    def test_snapshot_refreshes_cached_lockouts(self, mock_db, frozen_time):
+        other_container = DynamoDBTwitterList(mock_db._table)
+        assert not other_container.locked_out("123")
+        mock_db.lock_out(frozen_time().timestamp() + 60, scope="123")
+        other_container.quota_snapshot(["123"])
+        assert other_container.locked_out("123")
+
+    def test_opening_the_table_writes_nothing(self, mock_db):
+        mock_db.increment("app", amount=5)
+        with patch.object(mock_db._table, "put_item") as put_item:
+            DynamoDBTwitterList(mock_db._table)
+        put_item.assert_not_called()
+        assert mock_db.get_count("app") == 5
+
+
+class TestShardedCounters:
+    def test_app_counter_is_spread_over_shards(self, mock_db):
+        for _ in range(50):
+            mock_db.increase_counts("123", "app")
+        shards = [
+            item
+            for item in mock_db._table.scan()["Items"]
+            if item["user_id"].startswith("app#")
+        ]
+        assert len(shards) > 1
+        assert sum(item["count"] for item in shards) == 50
+        assert mock_db.get_count("app") == 50
+        assert mock_db.get_count("123") == 50
+
+    def test_increment_returns_the_total_of_the_shards(self, mock_db):
+        assert mock_db.increment("app", amount=5) == 5
+        assert mock_db.increment("app", amount=5) == 10
+
+    def test_totals_are_cached_briefly(self, mock_db, frozen_time):
+        other_container = DynamoDBTwitterList(mock_db._table)
+        assert other_container.quota_snapshot().app_count == 0
+        mock_db.increase_counts("123", "app", amount=3)
+        assert other_container.quota_snapshot().app_count == 0
+        assert other_container.quota_snapshot(fresh=True).app_count == 3
+        mock_db.increase_counts("123", "app", amount=3)
+        frozen_time.tick(datetime.timedelta(seconds=2))
+        assert other_container.quota_snapshot().app_count == 6
+
+    def test_own_increments_show_up_in_cached_totals(self, mock_db):
+        assert mock_db.quota_snapshot().app_count == 0
+        mock_db.increase_counts("123", "app", amount=3)
+        mock_db.reserve_quota("123", 4)
+        snapshot = mock_db.quota_snapshot()
+        assert snapshot.app_count == 3
+        assert snapshot.reserved == 4
+
+    def test_safety_margin_is_kept_back(self, mock_db, monkeypatch):
+        monkeypatch.setenv("APP_QUOTA_SAFETY_MARGIN", "10")
+        careful_db = DynamoDBTwitterList(mock_db._table)
+        mock_db.increment(RESERVATIONS_KEY, amount=985)
+        assert careful_db.quota_snapshot().app_left == 5
+        assert careful_db.reserve_quota("123", 10) == 5
+        assert careful_db.reserve_quota("123", 10) == 0
+
+
+class TestFollowLedger:
+    def test_follow_is_claimed_once(self, mock_db):
+        assert mock_db.claim_follow("123", "456")
+        assert not mock_db.claim_follow("123", "456")
+        assert mock_db.claim_follow("789", "456")
+
+    def test_claims_are_shared_between_containers(self, mock_db):
+        assert mock_db.claim_follow("123", "456")
+        assert not DynamoDBTwitterList(mock_db._table).claim_follow("123", "456")
+
+    def test_new_follows_are_not_read_first(self, mock_db):
+        with patch.object(mock_db._table, "get_item") as get_item:
+            assert mock_db.claim_follow("123", "456")
+        get_item.assert_not_called()
+
+    def test_released_follow_can_be_claimed_again(self, mock_db):
+        assert mock_db.claim_follow("123", "456")
+        mock_db.release_follow("123", "456")
+        assert mock_db.claim_follow("123", "456")
+
+
+class TestLockouts:
+    def test_lockout_is_shared_between_containers(self, mock_db, frozen_time):
+        other_container = DynamoDBTwitterList(mock_db._table)
+        assert not other_container.locked_out()
+        mock_db.lock_out(frozen_time().timestamp() + 60)
+        assert mock_db.locked_out()
+        # the other container trusts what it read for a few seconds, then sees the lockout
+        assert not other_container.locked_out()
+        frozen_time.tick(datetime.timedelta(seconds=5))
+        assert other_container.locked_out()
+        frozen_time.tick(datetime.timedelta(seconds=60))
+        assert not other_container.locked_out()
+
+    def test_lockout_is_never_shortened(self, mock_db, frozen_time):
+        now = frozen_time().timestamp()
+        mock_db.lock_out(now + 600)
+        mock_db.lock_out(now + 60)
+        assert mock_db.blocked_until() == now + 600
+        assert DynamoDBTwitterList(mock_db._table).blocked_until() == now + 600
+
+
+class TestDelayedJobs:
+    def test_only_due_jobs_are_returned(self, mock_db, frozen_time):
+        now = frozen_time().timestamp()
+        mock_db.defer_job("later", now + 3600)
+        first = mock_db.defer_job("first", now - 60)
+        second = mock_db.defer_job("second", now)
+        jobs = mock_db.due_jobs()
+        assert [(job["user_id"], job["body"]) for job in jobs] == [
+            (first, "first"),
+            (second, "second"),
+        ]
+        mock_db.delete_jobs([first, second])
+        assert mock_db.due_jobs() == []
+        assert [job["body"] for job in mock_db.due_jobs(now + 3600)] == ["later"]
+
+    def test_next_due_at_is_the_earliest_parked_job(self, mock_db, frozen_time):
+        now = frozen_time().timestamp()
+        assert mock_db.next_due_at() is None
+        mock_db.defer_job("later", now + 3600)
+        mock_db.defer_job("sooner", now + 60)
+        assert mock_db.next_due_at() == now + 60
+
+
+class TestWakeUps:
+    def test_only_a_sooner_wake_up_is_armed(self, mock_db, frozen_time):
+        now = frozen_time().timestamp()
+        assert mock_db.arm_wake_up(now + 3600)
+        assert not mock_db.arm_wake_up(now + 7200)
+        assert mock_db.arm_wake_up(now + 60)
+        # once the armed wake-up is due, the next one can be armed
+        frozen_time.tick(datetime.timedelta(minutes=1))
+        assert mock_db.arm_wake_up(now + 7200)
+
+
+class TestListSnapshots:
+    def test_snapshot_is_only_used_while_fresh(self, mock_db, frozen_time):
+        assert mock_db.get_list_snapshot("list-1", 3600) is None
+        mock_db.save_list_snapshot("list-1", ["30", "10", "20"])
+        assert mock_db.get_list_snapshot("list-1", 3600) == ["10", "20", "30"]
+        frozen_time.tick(datetime.timedelta(hours=1, seconds=1))
+        assert mock_db.get_list_snapshot("list-1", 3600) is None
+
+
+class TestSyncedMembers:
+    def test_synced_members_accumulate(self, mock_db):
+        assert mock_db.get_synced_members("123", "list-1") == set()
+        mock_db.add_synced_members("123", "list-1", ["1", "2"])
+        mock_db.add_synced_members("123", "list-1", ["2", "3"])
+        assert mock_db.get_synced_members("123", "list-1") == {"1", "2", "3"}
+        assert mock_db.get_synced_members("456", "list-1") == set()
+
+
+class TestCredentials:
+    def test_credentials_are_kept_per_user(self, mock_db):
+        assert mock_db.get_credentials("123") is None
+        mock_db.save_credentials("123", "token", "secret")
+        assert mock_db.get_credentials("123") == {
+            "access_token": "token",
+            "access_token_secret": "secret",
+        }
@@ -0,0 +1,39 @@
+import threading
+
+from chalicelib.executor import run_in_lanes
+
+
+class TestRunInLanes:
+    def test_lanes_run_at_the_same_time(self):
+        # each lane waits for the other, so this only finishes if they overlap
+        barrier = threading.Barrier(2, timeout=5)
+        done = run_in_lanes(
+            ["a1", "b1"],
+            lane=lambda item: item[0],
+            work=lambda item: barrier.wait(),
+            max_workers=2,
+        )
+        assert sorted(done) == ["a1", "b1"]
+
+    def test_items_in_a_lane_keep_their_order(self):
+        seen = []
+        run_in_lanes(
+            ["a1", "a2", "a3"],
+            lane=lambda item: item[0],
+            work=seen.append,
+            max_workers=4,
+        )
+        assert seen == ["a1", "a2", "a3"]
+
+    def test_failed_items_are_left_out(self):
+        def work(item):
+            if item == "a2":
+                raise RuntimeError("boom")
+
+        done = run_in_lanes(
+            ["a1", "a2", "a3", "b1"],
+            lane=lambda item: item[0],
+            work=work,
+            max_workers=2,
+        )
+        assert sorted(done) == ["a1", "a3", "b1"]
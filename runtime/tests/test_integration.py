@@ -1,14 +1,22 @@
 import datetime
+import itertools
 import json
+import os
 import random
+import time
+from typing import List
 from unittest.mock import patch, MagicMock, call
 
 import freezegun
 import pytest
 from chalice.test import Client
+from requests.structures import CaseInsensitiveDict
 from tweepy import RateLimitError, User
 
 import app as views
+from chalicelib.db import DynamoDBTwitterList, RESERVATIONS_KEY, reservations_of
+from chalicelib.process_follow import job_follower_ids, follow_job, reserved_job
+from tests.utils.tweepy_stub import cursor_stub, TweepyStub
 
 
 @pytest.fixture
@@ -20,6 +28,20 @@ def all_queues(mock_sqs_resource):
     ]
 
 
+def queued_follows(queue) -> List[str]:
+    """
+    Everyone the follow jobs on the queue ask to follow. The jobs are taken off the queue.
+    """
+    follows = []
+    while True:
+        messages = queue.receive_messages(MaxNumberOfMessages=10)
+        if not messages:
+            return follows
+        for message in messages:
+            follows.extend(job_follower_ids(json.loads(message.body)))
+            message.delete()
+
+
 @pytest.fixture
 def mock_message_as_object(mock_message_body_sent_to_process_queue):
     return json.loads(mock_message_body_sent_to_process_queue)
@@ -65,16 +87,210 @@ class TestIntegration:
         mock_friendship.assert_has_calls(
             [call(id=str(i)) for i in range(rate_error_index)]
         )
+        # the user is locked out for a day, longer than SQS can delay a message, so the rest are parked in the db
+        assert len(mock_db.due_jobs(now=time.time() + 86400)) == 10 - rate_error_index
         assert (
             int(mock_later_queue.attributes.get("ApproximateNumberOfMessagesDelayed"))
-            == 10 - rate_error_index
+            == 0
         )
 
+    @patch("app.tweepy.API.create_friendship")
+    def test_rate_limited_user_does_not_block_other_users(
+        self,
+        mock_friendship: MagicMock,
+        mock_sqs_resource,
+        mock_db,
+        mock_message_as_object,
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        for i in range(5):
+            for user_id in ("123", "456"):
+                mock_later_queue.send_message(
+                    MessageBody=json.dumps(
+                        {
+                            **mock_message_as_object,
+                            "user_id": user_id,
+                            "follower_id": f"{user_id}-{i}",
+                        }
+                    )
+                )
+
+        def create_friendship(id):
+            if id.startswith("123"):
+                raise RateLimitError("Too many requests", api_code=429)
+
+        mock_friendship.side_effect = create_friendship
+        with patch("app.queues", return_value=[None, mock_later_queue]), Client(
+            views.app
+        ) as client:
+            event = client.events.generate_cw_event(
+                source="test.aws.events",
+                detail_type="Scheduled Event",
+                detail={},
+                resources=[
+                    "arn:aws:events:us-east-1:123456789012:rule/MyScheduledRule"
+                ],
+                region="eu-west-test-1",
+            )
+            client.lambda_.invoke("process_later", event)
+        assert mock_db.locked_out("123")
+        assert not mock_db.locked_out("456")
+        assert not mock_db.locked_out()
+        assert mock_db.get_count("456") == 5
+        followed = [c.kwargs["id"] for c in mock_friendship.call_args_list]
+        assert [f for f in followed if f.startswith("123")] == ["123-0"]
+
+    def test_user_is_locked_out_when_rate_limit_is_used_up(
+        self,
+        mock_sqs_resource,
+        mock_db,
+        mock_message_as_object,
+        frozen_time,
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        reset = frozen_time().timestamp() + 120
+        api = MagicMock()
+        api.last_response.headers = CaseInsensitiveDict(
+            {"x-rate-limit-remaining": "0", "x-rate-limit-reset": str(reset)}
+        )
+        with patch("app.queues", return_value=[None, mock_later_queue]), patch(
+            "app.tweepy.API", return_value=api
+        ):
+            for i in range(2):
+                views.process_follow_from_record(
+                    MagicMock(
+                        body=json.dumps({**mock_message_as_object, "follower_id": i})
+                    )
+                )
+        api.create_friendship.assert_called_once_with(id=0)
+        assert mock_db.blocked_until("123") == reset
+        assert not mock_later_queue.receive_messages()
+        assert (
+            mock_later_queue.attributes.get("ApproximateNumberOfMessagesDelayed") == "1"
+        )
+
+    def test_batched_job_uses_stored_credentials(
+        self, mock_sqs_resource, mock_db, frozen_time
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        mock_db.save_credentials("123", "vault-token", "vault-secret")
+        job = follow_job({"user_id": "123", "job_id": "job-1"}, ["3", "1", "2"])
+        auth = MagicMock()
+        with patch("app.queues", return_value=[None, mock_later_queue]), patch(
+            "app.tweepy_auth", return_value=auth
+        ), patch("app.tweepy.API") as api:
+            views.process_follow_from_record(MagicMock(body=json.dumps(job)))
+        auth.set_access_token.assert_called_once_with("vault-token", "vault-secret")
+        assert api.return_value.create_friendship.call_args_list == [
+            call(id="1"),
+            call(id="2"),
+            call(id="3"),
+        ]
+        assert mock_db.get_count("123") == 3
+        assert queued_follows(mock_later_queue) == []
+
+    def test_client_is_set_up_once_per_user(
+        self, mock_sqs_resource, mock_db, mock_message_as_object
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        with patch("app.queues", return_value=[None, mock_later_queue]), patch(
+            "app.tweepy.API"
+        ) as api:
+            for i in range(3):
+                job = follow_job(mock_message_as_object, [str(i)])
+                views.process_follow_from_record(MagicMock(body=json.dumps(job)))
+        api.assert_called_once()
+        assert api.return_value.create_friendship.call_count == 3
+
+    def test_rest_of_batch_waits_when_user_is_locked_out(
+        self, mock_sqs_resource, mock_db, mock_message_as_object
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        job = follow_job(mock_message_as_object, ["1", "2", "3"])
+        api = MagicMock()
+        api.create_friendship.side_effect = [
+            None,
+            RateLimitError("Too many requests", api_code=429),
+        ]
+        with patch("app.queues", return_value=[None, mock_later_queue]), patch(
+            "app.tweepy.API", return_value=api
+        ):
+            views.process_follow_from_record(MagicMock(body=json.dumps(job)))
+        assert api.create_friendship.call_count == 2
+        assert mock_db.locked_out("123")
+        # a day is longer than SQS can delay a message
+        (parked,) = mock_db.due_jobs(now=time.time() + 86400)
+        assert job_follower_ids(json.loads(parked["body"])) == ["2", "3"]
+
+    def test_job_delivered_twice_follows_once(
+        self, mock_sqs_resource, mock_db, mock_message_as_object
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        job = follow_job(mock_message_as_object, ["1", "2"])
+        with patch("app.queues", return_value=[None, mock_later_queue]), patch(
+            "app.tweepy.API"
+        ) as api:
+            for _ in range(2):
+                views.process_follow_from_record(MagicMock(body=json.dumps(job)))
+            # a container that hasn't seen the job only has the ledger to go by
+            with patch(
+                "app.get_app_db", return_value=DynamoDBTwitterList(mock_db._table)
+            ):
+                views.process_follow_from_record(MagicMock(body=json.dumps(job)))
+        assert api.return_value.create_friendship.call_count == 2
+        assert mock_db.get_count("123") == 2
+
+    def test_follow_to_retry_is_given_back(
+        self, mock_sqs_resource, mock_db, mock_message_as_object
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        job = follow_job(mock_message_as_object, ["1", "2"])
+        api = MagicMock()
+        api.create_friendship.side_effect = [
+            None,
+            RateLimitError("Too many requests", api_code=429),
+        ]
+        with patch("app.queues", return_value=[None, mock_later_queue]), patch(
+            "app.tweepy.API", return_value=api
+        ):
+            views.process_follow_from_record(MagicMock(body=json.dumps(job)))
+        assert not mock_db.claim_follow("123", "1")
+        assert mock_db.claim_follow("123", "2")
+
+    def test_rest_of_batch_is_requeued_when_time_runs_out(
+        self, mock_sqs_resource, mock_db, mock_message_as_object
+    ):
+        mock_now_queue = mock_sqs_resource.create_queue(QueueName="test-now-queue")
+        job = follow_job(mock_message_as_object, ["1", "2", "3"])
+        api = MagicMock()
+        with patch("app.queues", return_value=[mock_now_queue, None]), patch(
+            "app.tweepy.API", return_value=api
+        ), patch("app.running_out_of_time", side_effect=[False, True]):
+            views.process_follow_from_record(
+                MagicMock(body=json.dumps(job)), MagicMock(), mock_now_queue
+            )
+        assert api.create_friendship.call_count == 2
+        assert queued_follows(mock_now_queue) == ["3"]
+
+    def test_due_jobs_are_released_to_the_later_queue(
+        self, mock_sqs_resource, mock_db, frozen_time
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        now = frozen_time().timestamp()
+        for i in range(25):
+            mock_db.defer_job(json.dumps({"follower_id": i}), now - i)
+        mock_db.defer_job(json.dumps({"follower_id": "tomorrow"}), now + 86400)
+        with patch("app.queues", return_value=[None, mock_later_queue]):
+            assert views.release_due_jobs() == 25
+        assert mock_later_queue.attributes.get("ApproximateNumberOfMessages") == "25"
+        assert mock_db.due_jobs() == []
+        assert len(mock_db.due_jobs(now + 86400)) == 1
+
     @pytest.mark.parametrize(
         ["people_to_follow", "expected_queue_values", "locked_until"],
         [
-            [0, 0, "2021-05-01 00:00:00"],
-            [400, 0, "2021-05-01 00:00:00"],
+            [0, 0, None],
+            [400, 0, None],
             [401, 1, "2021-05-02 00:00:00"],
             [800, 400, "2021-05-02 00:00:00"],
             [1000, 600, "2021-05-02 00:00:00"],
@@ -125,12 +341,25 @@ class TestIntegration:
             + int(
                 stubbed_later_queue.attributes.get("ApproximateNumberOfMessagesDelayed")
             )
+            + len(mock_db.due_jobs(now=time.time() + 86400, limit=1000))
             == expected_queue_values
         )
+        # the user's follows for today ran out before Twitter had to say so
         assert (
             mocked_tweepy.locked_until
-            == datetime.datetime.strptime(locked_until, "%Y-%m-%d %H:%M:%S").timestamp()
+            == datetime.datetime.strptime(
+                first_request_datetime, "%Y-%m-%d %H:%M:%S"
+            ).timestamp()
         )
+        if locked_until is None:
+            assert not mock_db.locked_out("123")
+        else:
+            assert (
+                mock_db.blocked_until("123")
+                == datetime.datetime.strptime(
+                    locked_until, "%Y-%m-%d %H:%M:%S"
+                ).timestamp()
+            )
 
     @pytest.mark.parametrize(
         ["people_to_follow", "users"],
@@ -195,19 +424,256 @@ class TestIntegration:
                 region="eu-west-test-1",
             )
             test_client.lambda_.invoke("process_later", event)
+        # every message was handled once and deleted, rather than left to reappear
+        assert stubbed_later_queue.attributes.get("ApproximateNumberOfMessages") == "0"
+        assert (
+            stubbed_later_queue.attributes.get("ApproximateNumberOfMessagesNotVisible")
+            == "0"
+        )
         if people_to_follow <= 400:
-            assert views.get_app_db().get_item("app").get("count") == people_to_follow
-            assert (
-                views.get_app_db().get_item(users[0]).get("count") == people_to_follow
-            )
+            assert views.get_app_db().get_count("app") == people_to_follow
+            assert views.get_app_db().get_count(users[0]) == people_to_follow
         else:
             timed_out_until = datetime.datetime.strptime(
                 "2021-05-01 00:00:00", "%Y-%m-%d %H:%M:%S"
             ) + datetime.timedelta(hours=24)
-            assert mocked_tweepy.locked_until == timed_out_until.timestamp()
-            assert views.get_app_db().get_item("app").get("count") <= 1000
+            # the user's follows for today ran out before Twitter had to say so
+            assert mocked_tweepy.locked_until == 0
+            assert mock_db.blocked_until(users[0]) == timed_out_until.timestamp()
+            assert views.get_app_db().get_count("app") <= 1000
             for user in users:
-                assert views.get_app_db().get_item(user).get("count") <= 400
+                assert views.get_app_db().get_count(user) <= 400
+
+    @patch("app.process_follow_from_record")
+    def test_drain_stops_when_todays_follows_are_used_up(
+        self,
+        mock_process_follow,
+        mock_sqs_resource,
+        mock_db,
+        mock_message_as_object,
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        for _ in range(2):
+            mock_later_queue.send_messages(
+                Entries=[
+                    {
+                        "Id": str(i),
+                        "MessageBody": json.dumps(
+                            {**mock_message_as_object, "follower_id": str(i)}
+                        ),
+                    }
+                    for i in range(10)
+                ]
+            )
+        mock_db.increment(RESERVATIONS_KEY, amount=995)
+        mock_process_follow.side_effect = (
+            lambda message, context: mock_db.reserve_quota(message.user_id, 1)
+        )
+        with patch("app.queues", return_value=[None, mock_later_queue]):
+            assert views.drain_later_queue() == 5
+            assert views.drain_later_queue() == 0
+        # the jobs that didn't get a turn are back on the queue
+        assert mock_later_queue.attributes.get("ApproximateNumberOfMessages") == "15"
+        assert mock_process_follow.call_count == 5
+
+    @patch("app.process_follow_from_record")
+    def test_small_request_is_not_held_up_by_a_long_list(
+        self, mock_process_follow, mock_sqs_resource, mock_db
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        jobs = [
+            follow_job({"user_id": "123"}, [str(i) for i in range(j, j + 200)])
+            for j in range(0, 600, 200)
+        ] + [follow_job({"user_id": "456"}, [str(i) for i in range(20)])]
+        for job in jobs:
+            mock_later_queue.send_message(MessageBody=json.dumps(job))
+        mock_db.increment(RESERVATIONS_KEY, amount=900)
+        followed = {}
+
+        def process_follow(job, context):
+            followed[job.user_id] = followed.get(job.user_id, 0) + len(job.follower_ids)
+            mock_db.reserve_quota(job.user_id, len(job.follower_ids))
+
+        mock_process_follow.side_effect = process_follow
+        with patch("app.queues", return_value=[None, mock_later_queue]):
+            views.drain_later_queue()
+        assert followed == {"123": 80, "456": 20}
+        assert sorted(map(int, queued_follows(mock_later_queue))) == list(
+            range(80, 600)
+        )
+
+    def test_reserved_follows_are_not_counted_again(
+        self,
+        test_client,
+        mock_db,
+        mock_sqs_resource,
+        mocked_tweepy,
+        mock_message_as_object,
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        # the fan-out reserves what it sends to the 'do now' queue and leaves the rest for later
+        assert mock_db.reserve_quota("123", 300) == 300
+        do_now = [
+            reserved_job(
+                follow_job(mock_message_as_object, [str(i) for i in range(j, j + 200)])
+            )
+            for j in (0, 200)
+        ]
+        do_now[1] = follow_job(do_now[1], [str(i) for i in range(200, 300)])
+        mock_later_queue.send_message(
+            MessageBody=json.dumps(
+                follow_job(mock_message_as_object, [str(i) for i in range(300, 400)])
+            )
+        )
+        with patch("app.queues", return_value=[None, mock_later_queue]), patch(
+            "app.tweepy.API", return_value=mocked_tweepy
+        ):
+            test_client.lambda_.invoke(
+                "process_now",
+                test_client.events.generate_sqs_event(
+                    message_bodies=list(map(json.dumps, do_now)), queue_name="do-now"
+                ),
+            )
+            assert views.drain_later_queue() == 1
+        assert mocked_tweepy.friends == [str(i) for i in range(400)]
+        assert mock_db.get_count("123") == 400
+        assert mock_db.get_count(reservations_of("123")) == 400
+        assert not mock_db.locked_out("123")
+        assert queued_follows(mock_later_queue) == []
+
+    def test_drained_follows_count_against_reservations(
+        self, mock_db, mock_sqs_resource, mock_message_as_object
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        users = {"1": 400, "2": 400, "3": 190}
+        for user_id, follows in users.items():
+            job = {
+                **mock_message_as_object,
+                "user_id": user_id,
+                "access_token": f"reserved-token-{user_id}",
+            }
+            for j in range(0, follows, 200):
+                ids = [str(i) for i in range(j, min(j + 200, follows))]
+                mock_later_queue.send_message(
+                    MessageBody=json.dumps(follow_job(job, ids))
+                )
+        with patch("app.queues", return_value=[None, mock_later_queue]), patch(
+            "app.tweepy.API", side_effect=lambda auth: TweepyStub("")
+        ):
+            views.drain_later_queue()
+        assert mock_db.get_count("app") == 990
+        assert mock_db.get_count(RESERVATIONS_KEY) == 990
+        assert mock_db.reserve_quota("4", 400) == 10
+
+    @patch("app.process_follow_from_record")
+    def test_drain_puts_back_what_it_has_no_time_for(
+        self, mock_process_follow, mock_sqs_resource, mock_db
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        for user_id in ("123", "456"):
+            mock_later_queue.send_message(
+                MessageBody=json.dumps(follow_job({"user_id": user_id}, ["1"]))
+            )
+        context = MagicMock()
+        # enough time to start the pass, receive the window and start the first job, then none
+        context.get_remaining_time_in_millis.side_effect = itertools.chain(
+            [60000] * 3, itertools.repeat(0)
+        )
+        with patch("app.queues", return_value=[None, mock_later_queue]), patch(
+            "app.follows_in_flight", return_value=1
+        ):
+            assert views.drain_later_queue(context) == 1
+        mock_process_follow.assert_called_once()
+        assert queued_follows(mock_later_queue) == ["1"]
+
+    def test_long_poll_ends_before_the_deadline(self, monkeypatch):
+        monkeypatch.setenv("APP_RECEIVE_WAIT_SECONDS", "20")
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 6000
+        queue = MagicMock()
+        queue.receive_messages.return_value = []
+        views.receive_window(queue, context)
+        assert queue.receive_messages.call_args.kwargs["WaitTimeSeconds"] == 5
+
+
+class TestWakeUps:
+    def test_wake_up_is_armed_for_tomorrow_when_follows_are_used_up(
+        self, mock_sqs_resource, mock_db, mock_wake_up_queue, frozen_time
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        mock_later_queue.send_message(
+            MessageBody=json.dumps(follow_job({"user_id": "456"}, ["1"]))
+        )
+        mock_db.increment(RESERVATIONS_KEY, amount=1000)
+        with patch("app.queues", return_value=[None, mock_later_queue]):
+            views.catch_up()
+        tomorrow = int(frozen_time().timestamp()) + 86400
+        mock_wake_up_queue.send_message.assert_called_once_with(
+            MessageBody=json.dumps({"wake_at": tomorrow}), DelaySeconds=900
+        )
+
+    def test_wake_up_is_armed_for_the_first_parked_job(
+        self, mock_sqs_resource, mock_db, mock_wake_up_queue, frozen_time
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        now = frozen_time().timestamp()
+        mock_db.defer_job("{}", now + 120)
+        with patch("app.queues", return_value=[None, mock_later_queue]):
+            assert views.arm_wake_up() == now + 120
+            # one is already on its way
+            assert views.arm_wake_up() is None
+        mock_wake_up_queue.send_message.assert_called_once_with(
+            MessageBody=json.dumps({"wake_at": now + 120}), DelaySeconds=120
+        )
+
+    def test_nothing_waiting_arms_nothing(
+        self, mock_sqs_resource, mock_db, mock_wake_up_queue
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        with patch("app.queues", return_value=[None, mock_later_queue]):
+            assert views.arm_wake_up() is None
+        mock_wake_up_queue.send_message.assert_not_called()
+
+    @patch("app.process_follow_from_record")
+    def test_follow_up_is_woken_when_time_runs_out(
+        self,
+        mock_process_follow,
+        mock_sqs_resource,
+        mock_db,
+        mock_wake_up_queue,
+        frozen_time,
+    ):
+        mock_later_queue = mock_sqs_resource.create_queue(QueueName="test-later-queue")
+        mock_later_queue.send_message(
+            MessageBody=json.dumps(follow_job({"user_id": "123"}, ["1"]))
+        )
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 0
+        with patch("app.queues", return_value=[None, mock_later_queue]):
+            views.catch_up(context)
+        mock_process_follow.assert_not_called()
+        now = frozen_time().timestamp()
+        mock_wake_up_queue.send_message.assert_called_once_with(
+            MessageBody=json.dumps({"wake_at": now}), DelaySeconds=0
+        )
+
+    @patch("app.catch_up")
+    def test_wake_up_waits_until_it_is_due(
+        self, mock_catch_up, test_client, mock_wake_up_queue, frozen_time
+    ):
+        wake_at = frozen_time().timestamp() + 3600
+        body = json.dumps({"wake_at": wake_at})
+        event = test_client.events.generate_sqs_event(
+            message_bodies=[body], queue_name="wake-up"
+        )
+        test_client.lambda_.invoke("wake_up", event)
+        mock_wake_up_queue.send_message.assert_called_once_with(
+            MessageBody=body, DelaySeconds=900
+        )
+        mock_catch_up.assert_not_called()
+        frozen_time.tick(datetime.timedelta(hours=1))
+        test_client.lambda_.invoke("wake_up", event)
+        mock_catch_up.assert_called_once()
 
 
 @patch("app.cursor", autospec=True)
@@ -249,7 +715,7 @@ class TestEnqueueFollowers:
         to_follow = [User(api=mocked_api) for i in range(people_to_follow)]
         for i, u in enumerate(to_follow):
             u.id_str = i
-        mock_cursor.return_value.items.return_value = to_follow
+        mock_cursor.side_effect = cursor_stub([to_follow])
         with mocked_api, mocked_queues:
             test_client.lambda_.invoke(
                 "enqueue_follows",
@@ -258,12 +724,8 @@ class TestEnqueueFollowers:
                     queue_name="process",
                 ),
             )
-            assert stubbed_later_queue.attributes.get(
-                "ApproximateNumberOfMessages"
-            ) == str(expected_queue_values[0])
-            assert stubbed_now_queue.attributes.get(
-                "ApproximateNumberOfMessages"
-            ) == str(expected_queue_values[1])
+            assert len(queued_follows(stubbed_later_queue)) == expected_queue_values[0]
+            assert len(queued_follows(stubbed_now_queue)) == expected_queue_values[1]
 
     @pytest.mark.parametrize(
         [
@@ -310,24 +772,179 @@ class TestEnqueueFollowers:
             [generate_mocked_user(f"{j}{i}") for i in range(10)] for j in range(10)
         ]
 
-        mock_cursor.return_value.items.side_effect = lists
+        mock_cursor.side_effect = cursor_stub(
+            {i: [members] for i, members in enumerate(lists)}
+        )
         message_bodies = list(
             map(
                 json.dumps,
                 ({**mock_message_as_object, "list_id": i} for i in range(10)),
             )
         )
+        event = test_client.events.generate_sqs_event(
+            message_bodies=message_bodies,
+            queue_name="process",
+        )
+        for i, record in enumerate(event["Records"]):
+            record["messageId"] = f"message-{i}"
         with mocked_api, mocked_queues:
-            test_client.lambda_.invoke(
-                "enqueue_follows",
-                test_client.events.generate_sqs_event(
-                    message_bodies=message_bodies,
-                    queue_name="process",
-                ),
-            )
+            test_client.lambda_.invoke("enqueue_follows", event)
+            # one job per list
             assert (
-                stubbed_later_queue.attributes.get("ApproximateNumberOfMessages") == "0"
+                stubbed_now_queue.attributes.get("ApproximateNumberOfMessages") == "10"
             )
-            assert (
-                stubbed_now_queue.attributes.get("ApproximateNumberOfMessages") == "100"
+            assert queued_follows(stubbed_later_queue) == []
+            assert len(queued_follows(stubbed_now_queue)) == 100
+
+    def test_fan_out_continues_in_chunks_without_duplicates(
+        self,
+        mock_cursor,
+        mocked_tweepy,
+        test_client,
+        mock_db,
+        all_queues,
+        mock_message_body_sent_to_process_queue,
+    ):
+        stubbed_now_queue, stubbed_later_queue, stubbed_process_queue = all_queues
+        pages = [[User(api=mocked_tweepy) for _ in range(10)] for _ in range(3)]
+        for i, user in enumerate(user for page in pages for user in page):
+            user.id_str = str(i)
+        mock_cursor.side_effect = cursor_stub(pages)
+        mock_db.increment("123", amount=385)
+
+        def invoke(body: str, message_id: str):
+            event = test_client.events.generate_sqs_event(
+                message_bodies=[body], queue_name="process"
+            )
+            event["Records"][0]["messageId"] = message_id
+            test_client.lambda_.invoke("enqueue_follows", event)
+
+        # every invocation thinks it's about to time out, so does one page and hands over
+        with patch("app.queues", return_value=all_queues), patch(
+            "app.reconstruct_twitter_api", return_value=mocked_tweepy
+        ), patch.dict(os.environ, {"APP_DEADLINE_MARGIN_MS": "60000"}):
+            invoke(mock_message_body_sent_to_process_queue, "original")
+            continuations = 0
+            while True:
+                messages = stubbed_process_queue.receive_messages()
+                if not messages:
+                    break
+                continuations += 1
+                invoke(messages[0].body, messages[0].message_id)
+                messages[0].delete()
+            # SQS delivers the original message again
+            invoke(mock_message_body_sent_to_process_queue, "original")
+
+        assert continuations == 2
+        followers = queued_follows(stubbed_now_queue) + queued_follows(
+            stubbed_later_queue
+        )
+        assert sorted(followers, key=int) == [str(i) for i in range(30)]
+        checkpoint = mock_db.get_checkpoint("original")
+        assert checkpoint["done"] and checkpoint["enqueued"] == 30
+
+    def test_list_is_fetched_once_for_everyone_following_it(
+        self,
+        mock_cursor,
+        mocked_tweepy,
+        test_client,
+        mock_db,
+        all_queues,
+        mock_message_as_object,
+    ):
+        stubbed_now_queue = all_queues[0]
+        members = [User(api=mocked_tweepy) for _ in range(5)]
+        for i, user in enumerate(members):
+            user.id_str = str(100 + i)
+        mock_cursor.side_effect = cursor_stub([members])
+        event = test_client.events.generate_sqs_event(
+            message_bodies=[
+                json.dumps({**mock_message_as_object, "user_id": user_id})
+                for user_id in ("123", "456")
+            ],
+            queue_name="process",
+        )
+        for i, record in enumerate(event["Records"]):
+            record["messageId"] = f"message-{i}"
+        with patch("app.queues", return_value=all_queues), patch(
+            "app.reconstruct_twitter_api", return_value=mocked_tweepy
+        ):
+            test_client.lambda_.invoke("enqueue_follows", event)
+
+        list_fetches = [
+            c
+            for c in mock_cursor.call_args_list
+            if c.args[0] == mocked_tweepy.list_members
+        ]
+        assert len(list_fetches) == 1
+        assert mock_db.get_list_snapshot("test-list-id", 60) == [
+            str(100 + i) for i in range(5)
+        ]
+        assert len(queued_follows(stubbed_now_queue)) == 10
+
+    def test_re_requested_list_only_enqueues_new_members(
+        self,
+        mock_cursor,
+        mocked_tweepy,
+        test_client,
+        mock_db,
+        all_queues,
+        frozen_time,
+        mock_message_body_sent_to_process_queue,
+    ):
+        stubbed_now_queue = all_queues[0]
+        members = [User(api=mocked_tweepy) for _ in range(8)]
+        for i, user in enumerate(members):
+            user.id_str = str(i)
+
+        def request_list(size: int, message_id: str):
+            mock_cursor.side_effect = cursor_stub([members[:size]])
+            event = test_client.events.generate_sqs_event(
+                message_bodies=[mock_message_body_sent_to_process_queue],
+                queue_name="process",
             )
+            event["Records"][0]["messageId"] = message_id
+            test_client.lambda_.invoke("enqueue_follows", event)
+            return queued_follows(stubbed_now_queue)
+
+        with patch("app.queues", return_value=all_queues), patch(
+            "app.reconstruct_twitter_api", return_value=mocked_tweepy
+        ):
+            assert sorted(request_list(5, "first-week")) == ["0", "1", "2", "3", "4"]
+            # long enough for the list to be fetched again
+            frozen_time.tick(datetime.timedelta(hours=2))
+            assert sorted(request_list(8, "second-week")) == ["5", "6", "7"]
+        assert mock_db.get_synced_members("123", "test-list-id") == {
+            str(i) for i in range(8)
+        }
+
+    def test_page_that_could_not_be_enqueued_is_retried(
+        self,
+        mock_cursor,
+        mocked_tweepy,
+        test_client,
+        mock_db,
+        all_queues,
+        mock_message_body_sent_to_process_queue,
+    ):
+        members = [User(api=mocked_tweepy) for _ in range(3)]
+        for i, user in enumerate(members):
+            user.id_str = str(i)
+        mock_cursor.side_effect = cursor_stub([members])
+        rejecting_queue = MagicMock()
+        rejecting_queue.send_messages.return_value = {
+            "Failed": [{"Id": "0", "SenderFault": False}]
+        }
+        event = test_client.events.generate_sqs_event(
+            message_bodies=[mock_message_body_sent_to_process_queue],
+            queue_name="process",
+        )
+        event["Records"][0]["messageId"] = "job-1"
+        with patch(
+            "app.queues", return_value=[rejecting_queue, *all_queues[1:]]
+        ), patch("app.reconstruct_twitter_api", return_value=mocked_tweepy):
+            response = test_client.lambda_.invoke("enqueue_follows", event)
+        assert response.payload == {"batchItemFailures": [{"itemIdentifier": "job-1"}]}
+        # nothing is recorded, so the retry starts from the same page
+        assert mock_db.get_checkpoint("job-1") == {}
+        assert mock_db.get_synced_members("123", "test-list-id") == set()
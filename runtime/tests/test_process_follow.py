@@ -0,0 +1,180 @@
+import datetime
+from unittest.mock import MagicMock
+
+import pytest
+import tweepy
+from requests.structures import CaseInsensitiveDict
+
+from chalicelib.process_follow import (
+    lockout_for_error,
+    rate_limit_from_response,
+    delay_until,
+    RateLimit,
+    Lockout,
+    USER_SCOPE,
+    APP_SCOPE,
+    DAY_SECONDS,
+    RETRY_SECONDS,
+    follow_job,
+    job_follower_ids,
+    ApiCache,
+)
+
+
+def response(status_code: int, headers: dict = None):
+    return MagicMock(status_code=status_code, headers=CaseInsensitiveDict(headers))
+
+
+# 2021-05-01 00:00:00, when the tests' clock is frozen
+NOW = 1619827200
+
+
+class TestLockoutForError:
+    @pytest.mark.parametrize(
+        ["error", "expected"],
+        [
+            (
+                tweepy.RateLimitError("Too many requests", api_code=429),
+                Lockout(USER_SCOPE, DAY_SECONDS, True),
+            ),
+            (
+                tweepy.TweepError("Rate limit exceeded", api_code=88),
+                Lockout(USER_SCOPE, DAY_SECONDS, True),
+            ),
+            (
+                tweepy.TweepError("Follow limit reached", api_code=161),
+                Lockout(USER_SCOPE, DAY_SECONDS, True),
+            ),
+            (
+                tweepy.TweepError("Invalid or expired token", api_code=89),
+                Lockout(USER_SCOPE, DAY_SECONDS, True),
+            ),
+            (
+                tweepy.TweepError("Too many requests", response=response(429)),
+                Lockout(USER_SCOPE, DAY_SECONDS, True),
+            ),
+            (
+                tweepy.TweepError("Application cannot write", api_code=261),
+                Lockout(APP_SCOPE, DAY_SECONDS, True),
+            ),
+            (
+                tweepy.TweepError("User not found", api_code=108),
+                Lockout(None, 0, False),
+            ),
+            (
+                tweepy.TweepError("Already requested", api_code=160),
+                Lockout(None, 0, False),
+            ),
+            (
+                tweepy.TweepError("Over capacity", api_code=130),
+                Lockout(None, 0, True),
+            ),
+            (
+                tweepy.TweepError("Bad gateway", response=response(502)),
+                Lockout(None, 0, True),
+            ),
+            (
+                tweepy.TweepError("Something else", response=response(400)),
+                Lockout(USER_SCOPE, RETRY_SECONDS, True),
+            ),
+        ],
+    )
+    def test_errors_are_scoped(self, error, expected):
+        assert lockout_for_error(error) == expected
+
+    def test_lockout_lasts_until_the_rate_limit_resets(self):
+        error = tweepy.RateLimitError(
+            "Too many requests",
+            response=response(
+                429, {"X-Rate-Limit-Remaining": "0", "X-Rate-Limit-Reset": NOW + 300}
+            ),
+            api_code=88,
+        )
+        assert lockout_for_error(error) == Lockout(USER_SCOPE, 300, True)
+
+    def test_reset_in_the_past_is_ignored(self):
+        error = tweepy.RateLimitError(
+            "Too many requests",
+            response=response(
+                429, {"X-Rate-Limit-Remaining": "0", "X-Rate-Limit-Reset": NOW - 1}
+            ),
+        )
+        assert lockout_for_error(error) == Lockout(USER_SCOPE, DAY_SECONDS, True)
+
+
+class TestRateLimits:
+    def test_headers_are_read(self):
+        assert rate_limit_from_response(
+            response(
+                200,
+                {"x-rate-limit-remaining": "14", "x-rate-limit-reset": "1619827500"},
+            )
+        ) == RateLimit(14, 1619827500)
+
+    @pytest.mark.parametrize(
+        "headers", [{}, {"x-rate-limit-remaining": "14"}, {"x-rate-limit-reset": "x"}]
+    )
+    def test_missing_headers(self, headers):
+        assert rate_limit_from_response(response(200, headers)) is None
+
+    def test_mocked_responses_have_no_rate_limit(self):
+        assert rate_limit_from_response(MagicMock()) is None
+        assert rate_limit_from_response(None) is None
+
+    @pytest.mark.parametrize(
+        ["until", "expected"], [(NOW - 10, 0), (NOW + 61.5, 62), (NOW + 86400, 900)]
+    )
+    def test_delay_until(self, until, expected):
+        assert delay_until(until) == expected
+
+
+class TestFollowJobs:
+    def test_jobs_carry_packed_ids_without_credentials(self):
+        request = {
+            "user_id": "123",
+            "job_id": "job-1",
+            "access_token": "token",
+            "access_token_secret": "secret",
+        }
+        job = follow_job({"user_id": "123", "job_id": "job-1"}, ["20", "10"])
+        assert set(job) == {"user_id", "job_id", "follower_ids"}
+        assert job_follower_ids(job) == ["10", "20"]
+        # a job made from an old single-follower message keeps its credentials
+        legacy = {**request, "follower_id": "7"}
+        assert job_follower_ids(legacy) == ["7"]
+        assert job_follower_ids(follow_job(legacy, ["8"])) == ["8"]
+        assert "follower_id" not in follow_job(legacy, ["8"])
+
+
+def credentials(token: str) -> dict:
+    return {"access_token": token, "access_token_secret": f"{token}-secret"}
+
+
+class TestApiCache:
+    def test_clients_are_reused_until_they_expire(self, frozen_time):
+        cache = ApiCache(ttl=60)
+        build = MagicMock(side_effect=lambda: MagicMock())
+        first = cache.get(credentials("a"), build)
+        assert cache.get(credentials("a"), build) is first
+        assert cache.get(credentials("b"), build) is not first
+        frozen_time.tick(datetime.timedelta(seconds=60))
+        assert cache.get(credentials("a"), build) is not first
+        assert build.call_count == 3
+
+    def test_least_recently_used_client_is_dropped(self):
+        cache = ApiCache(max_size=2)
+        build = MagicMock(side_effect=lambda: MagicMock())
+        a = cache.get(credentials("a"), build)
+        cache.get(credentials("b"), build)
+        cache.get(credentials("a"), build)
+        cache.get(credentials("c"), build)
+        assert cache.get(credentials("a"), build) is a
+        assert build.call_count == 3
+
+    def test_identity_is_asked_for_once(self):
+        api = MagicMock()
+        api.me.return_value.id_str = "123"
+        cached = ApiCache().get(credentials("a"), lambda: api)
+        assert cached.user_id() == "123"
+        assert cached.user_id() == "123"
+        api.me.assert_called_once()
@@ -4,31 +4,83 @@ from unittest.mock import patch, MagicMock, create_autospec, call
 import app as views
 import pytest
 from chalicelib.db import DynamoDBTwitterList
+from chalicelib.utils import encode_ids
+from tests.utils.tweepy_stub import cursor_stub
+
+
+def member(id_str: str, **flags) -> User:
+    user = User()
+    user.id_str = id_str
+    for flag, value in flags.items():
+        setattr(user, flag, value)
+    return user
+
+
+def accepting_queue() -> MagicMock:
+    queue = MagicMock()
+    queue.send_messages.side_effect = lambda Entries: {
+        "Successful": [{"Id": entry["Id"]} for entry in Entries]
+    }
+    return queue
 
 
 class TestRoutes:
-    @pytest.mark.parametrize(
-        "all_requests, user_requests, expected",
-        [(0, 0, 2), (1000, 0, 0), (0, 400, 0), (1000, 400, 0)],
-    )
     @patch("app.tweepy.API", autospec=True)
     @patch("app.get_app_db")
     @patch("app.cursor", autospec=True)
-    def test_get_people_to_follow(
-        self, mock_cursor, patched_db, mocked_api, all_requests, user_requests, expected
-    ):
+    def test_get_people_to_follow(self, mock_cursor, patched_db, mocked_api):
         """
-        This test checks whether 'get_people_to_follow' sorts requests into the right categories
+        This test checks whether 'get_people_to_follow' reserves quota for each page of the list and splits it into
+        follows for now and for later
         """
-        followers = [User(), User()]
-        mock_cursor.return_value.items.return_value = followers
-        patched_db.return_value.get_item.side_effect = [
-            {"count": all_requests},
-            {"count": user_requests},
+        pages = [[member(str(i)) for i in range(j, j + 2)] for j in (0, 2, 4)]
+        mock_cursor.side_effect = cursor_stub(pages)
+        patched_db.return_value.get_list_snapshot.return_value = None
+        patched_db.return_value.reserve_quota.side_effect = [2, 1]
+        assert list(views.get_people_to_follow(mocked_api, "test_id", "123")) == [
+            (["0", "1"], [], 2),
+            (["2"], ["3"], 3),
+            ([], ["4", "5"], 0),
+        ]
+        assert patched_db.return_value.reserve_quota.call_args_list == [
+            call("123", 2),
+            call("123", 2),
+        ]
+        mocked_api.me.assert_not_called()
+        patched_db.return_value.save_list_snapshot.assert_called_once_with(
+            "test_id", [str(i) for i in range(6)]
+        )
+
+    @patch("app.tweepy.API", autospec=True)
+    @patch("app.get_app_db")
+    @patch("app.cursor", autospec=True)
+    def test_people_already_followed_are_skipped(
+        self, mock_cursor, patched_db, mocked_api
+    ):
+        members = [
+            member("0"),
+            member("1", following=True),
+            member("2"),
+            member("3", protected=True, follow_request_sent=True),
+            member("4", protected=True, follow_request_sent=False),
+            member("5", following=False),
         ]
-        assert views.get_people_to_follow(mocked_api, "test_id") == (
-            followers,
-            expected,
+        # friends/ids pages contain integer ids
+        mock_cursor.side_effect = cursor_stub([members], [[2, 100], [101]])
+        patched_db.return_value.get_list_snapshot.return_value = None
+        patched_db.return_value.reserve_quota.return_value = 3
+        assert list(views.get_people_to_follow(mocked_api, "test_id")) == [
+            (["0", "4", "5"], [], 0)
+        ]
+        patched_db.return_value.reserve_quota.assert_called_once_with(
+            mocked_api.me.return_value.id_str, 3
+        )
+
+    def test_list_members_keep_only_ids_and_flags(self):
+        user = member("7", protected=True, follow_request_sent=True)
+        user.status = {"text": "a long tweet"}
+        assert views.ListMember.from_user(user) == views.ListMember(
+            "7", following=False, follow_request_sent=True, protected=True
         )
 
 
@@ -42,27 +94,9 @@ class TestEnqueueFollowers:
     @pytest.mark.parametrize(
         ["requests_to_process_now", "expected_now", "expected_later"],
         [
-            (
-                2,
-                [
-                    {"user_id": "123", "follower_id": "0"},
-                    {"user_id": "123", "follower_id": "1"},
-                ],
-                [],
-            ),
-            (
-                0,
-                [],
-                [
-                    {"user_id": "123", "follower_id": "0"},
-                    {"user_id": "123", "follower_id": "1"},
-                ],
-            ),
-            (
-                1,
-                [{"user_id": "123", "follower_id": "0"}],
-                [{"user_id": "123", "follower_id": "1"}],
-            ),
+            (2, ["0", "1"], []),
+            (0, [], ["0", "1"]),
+            (1, ["0"], ["1"]),
         ],
     )
     def test_enqueue_followers_with_default_list(
@@ -76,14 +110,21 @@ class TestEnqueueFollowers:
         test_client,
         mock_message_body_sent_to_process_queue,
     ):
-        to_follow = [MagicMock(), MagicMock()]
-        mock_later_queue = MagicMock()
-        mock_now_queue = MagicMock()
-        mock_queues.return_value = (mock_now_queue, mock_later_queue)
-
-        for i, u in enumerate(to_follow):
-            u.id_str = str(i)
-        mock_get_people_to_follow.return_value = (to_follow, requests_to_process_now)
+        to_follow = ["0", "1"]
+        mock_later_queue = accepting_queue()
+        mock_now_queue = accepting_queue()
+        mock_queues.return_value = (mock_now_queue, mock_later_queue, MagicMock())
+
+        mock_db.return_value.get_checkpoint.return_value = {}
+        mock_get_people_to_follow.return_value = iter(
+            [
+                (
+                    to_follow[:requests_to_process_now],
+                    to_follow[requests_to_process_now:],
+                    0,
+                )
+            ]
+        )
         test_client.lambda_.invoke(
             "enqueue_follows",
             test_client.events.generate_sqs_event(
@@ -91,20 +132,90 @@ class TestEnqueueFollowers:
                 queue_name="process",
             ),
         )
-        original_message = json.loads(mock_message_body_sent_to_process_queue)
-        expected_messages_now = [
-            call(MessageBody=message)
-            for message in map(
-                json.dumps,
-                ({**original_message, **follower_id} for follower_id in expected_now),
-            )
+
+        def expected_batches(followers):
+            if not followers:
+                return []
+            job = {
+                "user_id": "123",
+                "list_id": "test-list-id",
+                "job_id": "message-id",
+                "follower_ids": encode_ids(followers),
+            }
+            return [call(Entries=[{"Id": "0", "MessageBody": json.dumps(job)}])]
+
+        assert mock_now_queue.send_messages.call_args_list == expected_batches(
+            expected_now
+        )
+        assert mock_later_queue.send_messages.call_args_list == expected_batches(
+            expected_later
+        )
+        mock_now_queue.send_message.assert_not_called()
+        mock_later_queue.send_message.assert_not_called()
+        mock_db.return_value.save_credentials.assert_called_with(
+            "123", "test-access-token", "test-access_token_secret"
+        )
+
+
+@patch("app.queues", return_value=(MagicMock(), MagicMock(), MagicMock()))
+@patch("app.get_app_db")
+@patch("app.arm_wake_up", MagicMock())
+@patch("app.process_follow_from_record")
+class TestPartialBatchFailures:
+    def batch(self, test_client, size: int) -> dict:
+        event = test_client.events.generate_sqs_event(
+            message_bodies=[json.dumps({"follower_id": i}) for i in range(size)],
+            queue_name="do-now",
+        )
+        for i, record in enumerate(event["Records"]):
+            record["messageId"] = f"message-{i}"
+        return event
+
+    def test_only_failed_records_are_reported(
+        self, mock_process_follow, patched_db, mock_queues, test_client
+    ):
+        patched_db.return_value.locked_out.return_value = False
+        mock_process_follow.side_effect = [None, RuntimeError("boom"), None]
+        response = test_client.lambda_.invoke("process_now", self.batch(test_client, 3))
+        assert response.payload == {
+            "batchItemFailures": [{"itemIdentifier": "message-1"}]
+        }
+        assert mock_process_follow.call_count == 3
+
+    def test_records_left_when_time_runs_out_are_sent_on(
+        self, mock_process_follow, patched_db, mock_queues, test_client
+    ):
+        patched_db.return_value.locked_out.return_value = False
+        do_now_queue = mock_queues.return_value[0]
+        do_now_queue.send_messages.reset_mock()
+        do_now_queue.send_messages.side_effect = lambda Entries: {"Successful": Entries}
+        event = self.batch(test_client, 3)
+        with patch("app.running_out_of_time", return_value=True):
+            response = test_client.lambda_.invoke("process_now", event)
+        assert response.payload == {"batchItemFailures": []}
+        (entries,) = [
+            call.kwargs["Entries"] for call in do_now_queue.send_messages.call_args_list
         ]
-        expected_messages_later = [
-            call(MessageBody=message)
-            for message in map(
-                json.dumps,
-                ({**original_message, **follower_id} for follower_id in expected_later),
-            )
+        assert [entry["MessageBody"] for entry in entries] == [
+            record["body"] for record in event["Records"][1:]
         ]
-        mock_now_queue.send_message.assert_has_calls(expected_messages_now)
-        mock_later_queue.send_message.assert_has_calls(expected_messages_later)
+        mock_process_follow.assert_called_once()
+
+    def test_records_that_cant_be_sent_on_are_reported(
+        self, mock_process_follow, patched_db, mock_queues, test_client
+    ):
+        patched_db.return_value.locked_out.return_value = False
+        mock_queues.return_value[0].send_messages.side_effect = lambda Entries: {
+            "Successful": []
+        }
+        with patch("app.running_out_of_time", return_value=True):
+            response = test_client.lambda_.invoke(
+                "process_now", self.batch(test_client, 3)
+            )
+        assert response.payload == {
+            "batchItemFailures": [
+                {"itemIdentifier": "message-1"},
+                {"itemIdentifier": "message-2"},
+            ]
+        }
+        mock_process_follow.assert_called_once()
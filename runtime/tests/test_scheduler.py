@@ -0,0 +1,49 @@
+import json
+
+from chalicelib.process_follow import follow_job
+from chalicelib.scheduler import Job, deficit_round_robin, split_by_share
+
+
+def job(user_id: str, follower_ids) -> Job:
+    return Job.from_body(json.dumps(follow_job({"user_id": user_id}, follower_ids)))
+
+
+class TestDeficitRoundRobin:
+    def test_small_demand_is_met_in_full(self):
+        assert deficit_round_robin({"big": 5000, "small": 20}, 100) == {
+            "big": 80,
+            "small": 20,
+        }
+
+    def test_capacity_is_shared_evenly(self):
+        assert deficit_round_robin({"a": 100, "b": 100, "c": 100}, 90) == {
+            "a": 30,
+            "b": 30,
+            "c": 30,
+        }
+
+    def test_unused_capacity_is_left(self):
+        assert deficit_round_robin({"a": 5, "b": 0}, 100) == {"a": 5, "b": 0}
+
+    def test_quantum_sets_the_turn_size(self):
+        assert deficit_round_robin({"a": 100, "b": 100}, 25, quantum=20) == {
+            "a": 20,
+            "b": 5,
+        }
+
+
+class TestSplitByShare:
+    def test_job_straddling_the_share_is_split(self):
+        jobs = [job("a", ["1", "2", "3"]), job("a", ["4"]), job("b", ["5"])]
+        scheduled, leftover = split_by_share(jobs, {"a": 2, "b": 1})
+        assert [(j.user_id, j.follower_ids) for j in scheduled] == [
+            ("a", ["1", "2"]),
+            ("b", ["5"]),
+        ]
+        assert [(j.user_id, j.follower_ids) for j in leftover] == [
+            ("a", ["3"]),
+            ("a", ["4"]),
+        ]
+        # a job that wasn't split goes back as it came
+        assert leftover[1] == jobs[1]
+        assert Job.from_body(scheduled[0].body) == scheduled[0]
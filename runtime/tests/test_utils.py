@@ -0,0 +1,142 @@
+from unittest.mock import MagicMock
+
+import pytest
+from botocore.exceptions import ClientError
+
+from chalicelib.utils import (
+    BloomFilter,
+    send_messages_in_batches,
+    unsent_messages,
+    QueueRegistry,
+    pack_ids,
+    unpack_ids,
+    seconds_left,
+    running_out_of_time,
+)
+
+
+class TestSendMessagesInBatches:
+    def test_messages_are_sent_ten_at_a_time(self):
+        queue = MagicMock()
+        queue.send_messages.side_effect = lambda Entries: {
+            "Successful": [{"Id": entry["Id"]} for entry in Entries]
+        }
+        sent = send_messages_in_batches(queue, (str(i) for i in range(25)))
+        assert sent == 25
+        assert [
+            len(c.kwargs["Entries"]) for c in queue.send_messages.call_args_list
+        ] == [10, 10, 5]
+
+    def test_only_failed_entries_are_retried(self):
+        queue = MagicMock()
+        queue.send_messages.side_effect = [
+            {
+                "Successful": [{"Id": str(i)} for i in range(8)],
+                "Failed": [
+                    {"Id": "8", "SenderFault": False},
+                    {"Id": "9", "SenderFault": True},
+                ],
+            },
+            {"Successful": [{"Id": "8"}]},
+        ]
+        sent = send_messages_in_batches(queue, (str(i) for i in range(10)))
+        assert sent == 9
+        assert queue.send_messages.call_args_list[1].kwargs["Entries"] == [
+            {"Id": "8", "MessageBody": "8"}
+        ]
+
+    def test_unsent_messages_are_reported_by_position(self):
+        queue = MagicMock()
+        queue.send_messages.side_effect = lambda Entries: {
+            "Successful": [
+                {"Id": entry["Id"]}
+                for entry in Entries
+                if entry["MessageBody"] not in ("3", "12")
+            ],
+            "Failed": [
+                {"Id": entry["Id"], "SenderFault": entry["MessageBody"] == "3"}
+                for entry in Entries
+                if entry["MessageBody"] in ("3", "12")
+            ],
+        }
+        assert unsent_messages(queue, (str(i) for i in range(15))) == [3, 12]
+        assert send_messages_in_batches(queue, (str(i) for i in range(15))) == 13
+
+
+class TestQueueRegistry:
+    @pytest.fixture
+    def sqs_resource(self):
+        resource = MagicMock()
+        resource.meta.client.get_queue_url.side_effect = lambda QueueName: {
+            "QueueUrl": f"https://sqs/{QueueName}"
+        }
+        return resource
+
+    def test_queue_urls_are_resolved_once(self, sqs_resource):
+        registry = QueueRegistry(sqs_resource)
+        for _ in range(5):
+            registry.get("later").send_message(MessageBody="{}")
+            registry.get("now").send_message(MessageBody="{}")
+        assert sqs_resource.meta.client.get_queue_url.call_count == 2
+        sqs_resource.Queue.assert_any_call("https://sqs/test-later-queue")
+        sqs_resource.Queue.assert_any_call("https://sqs/test-now-queue")
+
+    def test_queue_url_is_refreshed_when_queue_no_longer_exists(self, sqs_resource):
+        stale_queue, fresh_queue = MagicMock(), MagicMock()
+        stale_queue.send_message.side_effect = ClientError(
+            {"Error": {"Code": "AWS.SimpleQueueService.NonExistentQueue"}},
+            "SendMessage",
+        )
+        sqs_resource.Queue.side_effect = [stale_queue, fresh_queue]
+        registry = QueueRegistry(sqs_resource)
+        registry.get("later").send_message(MessageBody="{}")
+        fresh_queue.send_message.assert_called_once_with(MessageBody="{}")
+        assert sqs_resource.meta.client.get_queue_url.call_count == 2
+
+    def test_other_errors_are_raised(self, sqs_resource):
+        sqs_resource.Queue.return_value.send_message.side_effect = ClientError(
+            {"Error": {"Code": "AccessDenied"}}, "SendMessage"
+        )
+        with pytest.raises(ClientError):
+            QueueRegistry(sqs_resource).get("later").send_message(MessageBody="{}")
+        assert sqs_resource.meta.client.get_queue_url.call_count == 1
+
+
+class TestTimeLeft:
+    def test_time_left_is_counted_to_the_deadline_margin(self):
+        # the test environment keeps a margin of one second
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 3500
+        assert seconds_left(context) == 2.5
+        assert not running_out_of_time(context)
+        context.get_remaining_time_in_millis.return_value = 999
+        assert running_out_of_time(context)
+
+    def test_without_a_context_there_is_no_deadline(self):
+        assert seconds_left(None) is None
+        assert not running_out_of_time(None)
+
+
+class TestPackIds:
+    def test_ids_round_trip_sorted_and_distinct(self):
+        ids = ["1390000000000000000", "12", "12", 783214]
+        assert unpack_ids(pack_ids(ids)) == ["12", "783214", "1390000000000000000"]
+
+    def test_nothing_packs_to_nothing(self):
+        assert unpack_ids(pack_ids([])) == []
+
+
+class TestBloomFilter:
+    def test_added_values_are_always_found(self):
+        seen = BloomFilter()
+        ids = [str(1390000000000000000 + i) for i in range(1000)]
+        for i in ids:
+            seen.add(i)
+        assert all(i in seen for i in ids)
+
+    def test_false_positives_are_rare(self):
+        seen = BloomFilter()
+        for i in range(1000):
+            seen.add(str(i))
+        false_positives = sum(str(i) in seen for i in range(1000, 11000))
+        assert false_positives < 50
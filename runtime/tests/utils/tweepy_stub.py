@@ -68,3 +68,48 @@ class TweepyStub(MagicMock):
 
     def _get_child_mock(self, **kw: Any) -> MagicMock:
         return MagicMock(**kw)
+
+
+class PagesStub(object):
+    """
+    Pages through a list of pages like tweepy's CursorIterator. A page's cursor is its position counting from 1, and
+    'next_cursor' is 0 after the last page.
+    """
+
+    def __init__(self, pages, start_cursor: int = -1):
+        self._pages = list(pages)
+        self._index = 0 if start_cursor in (-1, None) else start_cursor - 1
+        self.next_cursor = -1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._index >= len(self._pages):
+            raise StopIteration
+        page = self._pages[self._index]
+        self._index += 1
+        self.next_cursor = self._index + 1 if self._index < len(self._pages) else 0
+        return page
+
+
+def cursor_stub(list_pages, friends_pages=()):
+    """
+    Stands in for tweepy.Cursor. Paging through a list's members yields 'list_pages', or 'list_pages[list_id]' if it's
+    a dict, and paging through the user's friends yields 'friends_pages'.
+    """
+
+    def _cursor(method, *args, **kwargs):
+        stub = MagicMock()
+        if "list_id" in kwargs:
+            pages = (
+                list_pages[kwargs["list_id"]]
+                if isinstance(list_pages, dict)
+                else list_pages
+            )
+            stub.pages.return_value = PagesStub(pages, kwargs.get("cursor", -1))
+        else:
+            stub.pages.return_value = iter(friends_pages)
+        return stub
+
+    return _cursor